@@ -1,10 +1,101 @@
-from flask import Flask
+import os
+import json
+import time
+from flask import Flask, Response, jsonify
 app = Flask(__name__)
 
+# Written by the bot process (metrics.writer). Read from the environment directly
+# so the web process does not need the bot's credentials to import config.
+METRICS_PATH = os.environ.get("METRICS_PATH", "metrics.json")
+
+
+def load_metrics():
+    try:
+        with open(METRICS_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(data):
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{escape_label(val)}"' for key, val in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    gauges = data.get("gauges", {})
+    counters = data.get("counters", {})
+    rates = data.get("rates", {})
+    disk = data.get("disk", {})
+    metric("wmbot_metrics_age_seconds", "gauge", "Seconds since the bot wrote this snapshot.",
+           [({}, round(time.time() - data.get("updated", 0), 1))])
+    metric("wmbot_jobs_active", "gauge", "Jobs currently running.", [({}, gauges.get("jobs_active", 0))])
+    metric("wmbot_jobs_queued", "gauge", "Jobs waiting for a worker.", [({}, gauges.get("jobs_queued", 0))])
+    encodes = data.get("encodes", [])
+    metric("wmbot_encode_fps", "gauge", "Current encode frames per second per job.",
+           [({"job": e["label"]}, e["fps"]) for e in encodes])
+    metric("wmbot_encode_speed", "gauge", "Current encode speed per job, as a multiple of real time.",
+           [({"job": e["label"]}, e["speed"]) for e in encodes])
+    for direction in ("download", "upload"):
+        metric(f"wmbot_{direction}_bytes_total", "counter", f"Bytes transferred by {direction}s.",
+               [({}, counters.get(f"{direction}_bytes_total", 0))])
+        metric(f"wmbot_{direction}_bytes_per_second", "gauge", f"Recent {direction} throughput.",
+               [({}, rates.get(f"{direction}_bytes_per_second", 0))])
+    metric("wmbot_temp_bytes", "gauge", "Disk used by job temp directories.", [({}, disk.get("temp_bytes", 0))])
+    metric("wmbot_temp_reserved_bytes", "gauge", "Temp space reserved for the projected footprint of running jobs.",
+           [({}, gauges.get("temp_reserved_bytes", 0))])
+    metric("wmbot_temp_free_bytes", "gauge", "Free space on the temp file system.", [({}, disk.get("temp_free_bytes", 0))])
+    metric("wmbot_flood_waits_total", "counter", "FloodWait errors returned by Telegram.",
+           [({}, counters.get("flood_waits_total", 0))])
+
+    sessions = gauges.get("sessions", [])
+    metric("wmbot_session_active_transfers", "gauge", "Transfers running on each Telegram session.",
+           [({"session": x["session"]}, x["active"]) for x in sessions])
+    metric("wmbot_session_healthy", "gauge", "Whether each Telegram session is healthy (1) or failing (0).",
+           [({"session": x["session"]}, int(x["healthy"])) for x in sessions])
+    metric("wmbot_session_flood_waits_total", "counter", "FloodWait errors per Telegram session during transfers.",
+           [({"session": x["session"]}, x["flood_waits"]) for x in sessions])
+
+    bounds = data.get("stage_buckets", [])
+    lines.append("# HELP wmbot_stage_seconds Latency of pipeline stages.")
+    lines.append("# TYPE wmbot_stage_seconds histogram")
+    for stage, hist in data.get("stages", {}).items():
+        for bound, count in zip(bounds, hist["buckets"]):
+            lines.append(f'wmbot_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'wmbot_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist["count"]}')
+        lines.append(f'wmbot_stage_seconds_sum{{stage="{stage}"}} {round(hist["sum"], 3)}')
+        lines.append(f'wmbot_stage_seconds_count{{stage="{stage}"}} {hist["count"]}')
+    return "\n".join(lines) + "\n"
+
+
 @app.route('/')
 def hello_world():
     return 'Hello from Tech VJ'
 
 
+@app.route('/metrics')
+def metrics():
+    data = load_metrics()
+    if data is None:
+        return Response("# bot metrics not available yet\n", status=503, mimetype="text/plain")
+    return Response(render_prometheus(data), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/status')
+def status():
+    data = load_metrics()
+    if data is None:
+        return jsonify({"error": "bot metrics not available yet"}), 503
+    return jsonify(data)
+
+
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import logging
+
+from config import FFMPEG_PATH, ENCODER_SLOTS, THROUGHPUT_TABLE_PATH, AUTO_TARGET_TIME, AUTO_TARGET_FPS
+from encoding import build_encode_cmd, encoder_slots
+from media import run_process
+from sprites import prepare_watermark
+
+logger = logging.getLogger(__name__)
+
+# Slowest (best compression) first; "auto" picks the first one that meets the target.
+PRESETS = ["medium", "fast", "superfast", "ultrafast"]
+
+# Rough libx264 + drawtext throughput in megapixels per second at ENCODE_THREADS
+# threads, used until /calibrate has measured this host.
+DEFAULT_TABLE = {
+    "measured_at": None,
+    "presets": {
+        "medium": {"mpix_per_sec": 20.0, "crf": 23},
+        "fast": {"mpix_per_sec": 30.0, "crf": 23},
+        "superfast": {"mpix_per_sec": 70.0, "crf": 24},
+        "ultrafast": {"mpix_per_sec": 110.0, "crf": 25},
+    },
+}
+
+# Synthetic clips for calibration: (width, height, seconds) at 30 fps.
+CALIBRATION_CLIPS = [(1280, 720, 10), (1920, 1080, 10)]
+
+# ─── Throughput Table ───
+def load_table():
+    try:
+        with open(THROUGHPUT_TABLE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return DEFAULT_TABLE
+
+def save_table(table):
+    tmp_path = THROUGHPUT_TABLE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(table, f, indent=2)
+    os.replace(tmp_path, THROUGHPUT_TABLE_PATH)
+
+def format_eta(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes}m" if hours else f"{minutes}m {seconds}s"
+
+# ─── Profile Selection ───
+def estimate_seconds(table, preset, width, height, duration, fps, parallel=1):
+    mpix = width * height * duration * fps / 1e6
+    return mpix / (table["presets"][preset]["mpix_per_sec"] * parallel)
+
+def choose_profile(width, height, duration, fps, parallel=1, table=None):
+    """
+    Pick preset/CRF for a clip: the slowest preset whose estimated encode
+    time meets AUTO_TARGET_TIME, or, if AUTO_TARGET_FPS is set, whose
+    estimated speed reaches that many frames per second. Falls back to the
+    fastest preset. `parallel` encoders count only up to ENCODER_SLOTS.
+    Returns a dict with preset, crf and eta (seconds).
+    """
+    table = table or load_table()
+    parallel = max(1, min(parallel, ENCODER_SLOTS))
+    width, height, fps = width or 1280, height or 720, fps or 30
+    chosen = PRESETS[-1]
+    for preset in PRESETS:
+        eta = estimate_seconds(table, preset, width, height, duration, fps, parallel)
+        if AUTO_TARGET_FPS:
+            encode_fps = duration * fps / eta if eta else float("inf")
+            if encode_fps >= AUTO_TARGET_FPS:
+                chosen = preset
+                break
+        elif eta <= AUTO_TARGET_TIME:
+            chosen = preset
+            break
+    return {
+        "preset": chosen,
+        "crf": table["presets"][chosen]["crf"],
+        "eta": estimate_seconds(table, chosen, width, height, duration, fps, parallel),
+    }
+
+# ─── Calibration on Synthetic Clips ───
+async def calibrate(work_dir):
+    """
+    Measure watermark encode throughput for every preset on lavfi test clips
+    and store the result as the throughput table. Every ffmpeg run takes an
+    encoder slot like a job's encode, so calibration neither overloads the
+    host nor measures throughput squeezed by jobs beyond the slot budget.
+    Returns the new table.
+    """
+    state = await prepare_watermark({'mode': 'watermark', 'watermark_text': 'Calibration', 'font_size': 32, 'font_color': 'white'})
+    table = {"measured_at": time.strftime("%Y-%m-%d %H:%M:%S"), "presets": {}}
+    clips = []
+    for width, height, seconds in CALIBRATION_CLIPS:
+        clip = os.path.join(work_dir, f"calibration_{width}x{height}.mp4")
+        async with encoder_slots():
+            returncode, _, stderr = await run_process([
+                FFMPEG_PATH, "-y",
+                "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate=30:duration={seconds}",
+                "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+                "-c:v", "libx264", "-preset", "ultrafast", "-crf", "18", "-pix_fmt", "yuv420p",
+                "-c:a", "aac", "-shortest", clip
+            ])
+        if returncode != 0:
+            raise RuntimeError(f"could not generate calibration clip: {stderr.decode('utf-8', errors='replace')}")
+        clips.append((clip, width * height * seconds * 30 / 1e6))
+    for preset in PRESETS:
+        total_mpix = 0.0
+        total_time = 0.0
+        for clip, mpix in clips:
+            output = os.path.join(work_dir, f"calibration_{preset}.mp4")
+            async with encoder_slots():
+                started = time.monotonic()
+                returncode, _, _ = await run_process(build_encode_cmd(clip, output, dict(state, preset=preset)))
+            if returncode != 0:
+                raise RuntimeError(f"calibration encode failed for preset {preset}")
+            total_time += time.monotonic() - started
+            total_mpix += mpix
+        table["presets"][preset] = {
+            "mpix_per_sec": round(total_mpix / total_time, 2),
+            "crf": DEFAULT_TABLE["presets"][preset]["crf"],
+        }
+        logger.info(f"Calibrated {preset}: {table['presets'][preset]['mpix_per_sec']} Mpix/s")
+    save_table(table)
+    return table
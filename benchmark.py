@@ -0,0 +1,174 @@
+"""
+Offline benchmark of the media paths: watermark encodes (every mode, preset and
+renderer), thumbnail generation, probing and both splitters, run on synthetic
+lavfi clips so results are comparable between commits and hosts.
+
+    python benchmark.py [--output bench.json] [--quick]
+
+Needs ffmpeg; bot credentials are not required.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+from config import FFMPEG_PATH
+from encoding import build_encode_cmd, split_video_file
+from media import run_process, generate_thumbnail
+from splitter import split_video_by_size
+from probe import get_video_details
+from sprites import prepare_watermark
+from autotune import PRESETS
+
+logger = logging.getLogger(__name__)
+
+# Synthetic inputs: (width, height, seconds) at 30 fps with a sine audio track.
+CLIPS = [(640, 360, 10), (1280, 720, 20), (1920, 1080, 20)]
+QUICK_CLIPS = [(640, 360, 5)]
+MODES = ["watermark", "watermarktm"]
+RENDERERS = ["drawtext", "sprite"]
+FPS = 30
+
+# ─── Synthetic Inputs ───
+async def make_clip(work_dir, width, height, seconds):
+    path = os.path.join(work_dir, f"clip_{width}x{height}_{seconds}s.mp4")
+    returncode, _, stderr = await run_process([
+        FFMPEG_PATH, "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={FPS}:duration={seconds}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+        "-c:v", "libx264", "-preset", "ultrafast", "-crf", "18", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-shortest", path
+    ])
+    if returncode != 0:
+        raise RuntimeError(f"could not generate {path}: {stderr.decode('utf-8', errors='replace')}")
+    return path
+
+# ─── Measurement ───
+def children_peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+def ffmpeg_maxrss_kb(output):
+    # ffmpeg -benchmark ends its log with "bench: utime=... maxrss=NKiB".
+    match = re.search(rb"maxrss=(\d+)KiB", output)
+    return int(match.group(1)) if match else None
+
+async def measure(stage, clip, run, frames=0, **params):
+    """
+    Time `await run()`, which returns a truthy value on success, and build one report row.
+    If run() returns a dict with "maxrss_kb" (an ffmpeg -benchmark figure),
+    that is the stage's peak_rss_kb. Otherwise it comes from the children's
+    high-water mark, which only moves when the stage beats every earlier
+    child, so it is null for a stage that stayed below that.
+    """
+    before = children_peak_rss_kb()
+    started = time.monotonic()
+    try:
+        result = await run()
+    except Exception as e:
+        logger.error(f"{stage} failed on {clip}: {e}")
+        result = None
+    ok = bool(result)
+    after = children_peak_rss_kb()
+    wall_time = time.monotonic() - started
+    row = {
+        "stage": stage,
+        "clip": os.path.basename(clip),
+        **params,
+        "ok": ok,
+        "wall_time": round(wall_time, 3),
+        "fps": round(frames / wall_time, 2) if frames and ok else None,
+        "peak_rss_kb": result.get("maxrss_kb") if isinstance(result, dict) else (after if after > before else None),
+    }
+    logger.info(json.dumps(row))
+    return row
+
+async def bench_clip(work_dir, clip, width, height, seconds, presets):
+    rows = []
+    frames = seconds * FPS
+    for mode in MODES:
+        base_state = {'mode': mode, 'watermark_text': 'Benchmark', 'font_size': max(height // 20, 12), 'font_color': 'white'}
+        for renderer in RENDERERS:
+            state = await prepare_watermark(base_state) if renderer == "sprite" else base_state
+            if renderer == "sprite" and not state.get('sprite'):
+                continue  # sprites disabled or font missing on this host
+            for preset in presets:
+                output = os.path.join(work_dir, "encoded.mp4")
+                cmd = build_encode_cmd(clip, output, dict(state, preset=preset))
+                cmd.insert(1, "-benchmark")
+
+                async def encode():
+                    returncode, _, stderr = await run_process(cmd)
+                    return {"maxrss_kb": ffmpeg_maxrss_kb(stderr)} if returncode == 0 else None
+
+                rows.append(await measure("encode", clip, encode, frames, mode=mode, renderer=renderer, preset=preset))
+    rows.append(await measure("thumbnail", clip, lambda: generate_thumbnail(clip, os.path.join(work_dir, "thumb.jpg"))))
+    rows.append(await measure("probe", clip, lambda: get_video_details(clip)))
+
+    split_dir = os.path.join(work_dir, "split_by_size")
+    os.makedirs(split_dir, exist_ok=True)
+    size = os.path.getsize(clip) // 3 + 1
+    rows.append(await measure("split_video_by_size", clip, lambda: split_video_by_size(clip, split_dir, size), segment_size=size))
+    shutil.rmtree(split_dir, True)
+
+    split_dir = os.path.join(work_dir, "split_by_time")
+    os.makedirs(split_dir, exist_ok=True)
+    segment_time = seconds / 3
+    rows.append(await measure("split_video_file", clip, lambda: split_video_file(clip, split_dir, segment_time), segment_time=segment_time))
+    shutil.rmtree(split_dir, True)
+    return rows
+
+# ─── Report ───
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def ffmpeg_version():
+    returncode, stdout, _ = await run_process([FFMPEG_PATH, "-version"])
+    return stdout.decode("utf-8", errors="replace").splitlines()[0] if returncode == 0 else None
+
+async def run_benchmarks(quick=False):
+    work_dir = tempfile.mkdtemp(prefix="wmbench_")
+    presets = PRESETS[-1:] if quick else PRESETS
+    results = []
+    try:
+        for width, height, seconds in (QUICK_CLIPS if quick else CLIPS):
+            clip = await make_clip(work_dir, width, height, seconds)
+            results += await bench_clip(work_dir, clip, width, height, seconds, presets)
+            os.remove(clip)
+    finally:
+        shutil.rmtree(work_dir, True)
+    return {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "ffmpeg": await ffmpeg_version(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "results": results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the watermark, thumbnail, probe and split paths.")
+    parser.add_argument("--output", default="bench.json", help="where to write the JSON report")
+    parser.add_argument("--quick", action="store_true", help="one small clip and the fastest preset only")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    report = asyncio.run(run_benchmarks(args.quick))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    failed = [row for row in report["results"] if not row["ok"]]
+    logger.info(f"Wrote {len(report['results'])} results to {args.output} ({len(failed)} failed).")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
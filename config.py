@@ -1,9 +1,137 @@
 import os
+import tempfile
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 API_ID = int(os.environ.get("API_ID", 0))
 API_HASH = os.environ.get("API_HASH")
 FFMPEG_PATH = os.environ.get("FFMPEG_PATH", "ffmpeg")  # Defaults to using 'ffmpeg' from the system PATH
+FFPROBE_PATH = os.environ.get("FFPROBE_PATH", FFMPEG_PATH.replace("ffmpeg", "ffprobe"))
 
-if not BOT_TOKEN or API_ID == 0 or not API_HASH:
-    raise ValueError("Missing required bot configuration. Please set BOT_TOKEN, API_ID, and API_HASH as environment variables.")
+def check_bot_config():
+    # Only the bot itself needs credentials; the offline tools (benchmark.py) import config without them.
+    if not BOT_TOKEN or API_ID == 0 or not API_HASH:
+        raise ValueError("Missing required bot configuration. Please set BOT_TOKEN, API_ID, and API_HASH as environment variables.")
+
+# Bulk pipeline: how many finished items each stage may hold before the previous stage waits.
+BULK_QUEUE_SIZE = int(os.environ.get("BULK_QUEUE_SIZE", 1))
+
+# Job scheduler: libx264 threads per job, and how many jobs may encode at once.
+ENCODE_THREADS = int(os.environ.get("ENCODE_THREADS", 4))
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", 0)) or max(1, (os.cpu_count() or 1) // ENCODE_THREADS)
+
+# Parallel encode mode: inputs at least PARALLEL_MIN_DURATION seconds long are cut at
+# keyframes and encoded up to PARALLEL_CHUNKS chunks at a time (each with ENCODE_THREADS threads),
+# within the ENCODER_SLOTS budget shared with every other encode.
+# Set PARALLEL_CHUNKS=1 to disable.
+PARALLEL_CHUNKS = int(os.environ.get("PARALLEL_CHUNKS", 0)) or max(1, (os.cpu_count() or 1) // ENCODE_THREADS)
+PARALLEL_MIN_DURATION = int(os.environ.get("PARALLEL_MIN_DURATION", 600))
+# x264 encoders running at once across all jobs (chunk encoders included), each with ENCODE_THREADS threads.
+ENCODER_SLOTS = int(os.environ.get("ENCODER_SLOTS", 0)) or max(1, (os.cpu_count() or 1) // ENCODE_THREADS)
+
+# Number of ffprobe results kept in the in-memory LRU cache.
+PROBE_CACHE_SIZE = int(os.environ.get("PROBE_CACHE_SIZE", 256))
+
+# Media toolkit: concurrent short ffmpeg/ffprobe calls, their timeout in seconds,
+# and threads for the remaining blocking work.
+MEDIA_CONCURRENCY = int(os.environ.get("MEDIA_CONCURRENCY", 4))
+MEDIA_TIMEOUT = int(os.environ.get("MEDIA_TIMEOUT", 120))
+MEDIA_THREADS = int(os.environ.get("MEDIA_THREADS", 4))
+
+# Streaming ingest: pipe streamable single-video downloads straight into ffmpeg ("0" to disable).
+STREAM_INGEST = os.environ.get("STREAM_INGEST", "1") == "1"
+
+# Result cache: file_ids of uploaded outputs, reused for identical repeat requests.
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", "result_cache.db")
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", 5000))
+RESULT_CACHE_MAX_AGE = int(os.environ.get("RESULT_CACHE_MAX_AGE", 30 * 24 * 3600))  # seconds
+# Total size of the outputs the cache may point at; least recently used entries go first.
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 2 * 1024 ** 4))
+
+# "auto" preset: measured throughput table, and the target it aims for. A non-zero
+# AUTO_TARGET_FPS takes precedence over the target completion time in seconds.
+THROUGHPUT_TABLE_PATH = os.environ.get("THROUGHPUT_TABLE_PATH", "throughput.json")
+AUTO_TARGET_TIME = int(os.environ.get("AUTO_TARGET_TIME", 900))
+AUTO_TARGET_FPS = float(os.environ.get("AUTO_TARGET_FPS", 0))
+
+# Text watermark rendering: "sprite" rasterises the text once and composites it with
+# overlay; "drawtext" renders it on every frame. Sprites are cached in SPRITE_CACHE_DIR.
+WATERMARK_RENDERER = os.environ.get("WATERMARK_RENDERER", "sprite")
+SPRITE_CACHE_DIR = os.environ.get("SPRITE_CACHE_DIR", "sprite_cache")
+DEFAULT_FONT_PATH = os.environ.get("DEFAULT_FONT_PATH", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf")
+
+# Telegram API budget shared by all jobs, and the minimum seconds between edits of one message.
+API_CALLS_PER_SECOND = float(os.environ.get("API_CALLS_PER_SECOND", 20))
+EDIT_INTERVAL = float(os.environ.get("EDIT_INTERVAL", 3))
+
+# Seconds between sampled ffmpeg progress log lines per encode.
+PROGRESS_LOG_INTERVAL = float(os.environ.get("PROGRESS_LOG_INTERVAL", 30))
+
+# Metrics snapshot written by the bot every METRICS_INTERVAL seconds and served by app.py.
+METRICS_PATH = os.environ.get("METRICS_PATH", "metrics.json")
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL", 5))
+
+# Persistent job store: submitted jobs and per-video status, resumed after a restart or crash.
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", "jobs.db")
+
+# Temp storage: jobs work in SCRATCH_DIR, or in SMALL_SCRATCH_DIR (e.g. a tmpfs) when
+# their projected footprint (input size x FOOTPRINT_FACTOR) is at most SMALL_JOB_LIMIT.
+# Jobs wait for space while the footprints reserved on a directory would exceed its
+# budget; a budget of 0 means the free space at startup minus TEMP_RESERVE.
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR", tempfile.gettempdir())
+TEMP_BUDGET = int(os.environ.get("TEMP_BUDGET", 0))
+TEMP_RESERVE = int(os.environ.get("TEMP_RESERVE", 1024 ** 3))
+FOOTPRINT_FACTOR = float(os.environ.get("FOOTPRINT_FACTOR", 2.5))
+SMALL_SCRATCH_DIR = os.environ.get("SMALL_SCRATCH_DIR", "")
+SMALL_SCRATCH_BUDGET = int(os.environ.get("SMALL_SCRATCH_BUDGET", 0))
+SMALL_JOB_LIMIT = int(os.environ.get("SMALL_JOB_LIMIT", 200 * 1024 ** 2))
+
+# Checkpointed encoding: jobs work in a persistent directory per input and settings, and
+# inputs at least CHECKPOINT_MIN_DURATION seconds long are encoded as keyframe chunks
+# recorded in a manifest, so a re-run after a failure, /stop or restart only encodes the
+# missing chunks. Directories untouched for CHECKPOINT_MAX_AGE seconds are removed.
+# Opt-in: checkpointed inputs always take the chunked path (an extra split pass and a second
+# copy of the input on disk), which skips streaming ingest and encode-time segmentation.
+CHECKPOINT_ENCODE = os.environ.get("CHECKPOINT_ENCODE", "0") == "1"
+CHECKPOINT_DIR = os.environ.get("CHECKPOINT_DIR", os.path.join(SCRATCH_DIR, "wmbot_checkpoints"))
+CHECKPOINT_MIN_DURATION = int(os.environ.get("CHECKPOINT_MIN_DURATION", 300))
+CHECKPOINT_MAX_AGE = int(os.environ.get("CHECKPOINT_MAX_AGE", 2 * 24 * 3600))
+
+# Size-targeted rate control: cap the video bitrate so the whole output fits in one
+# upload. Below MIN_VIDEO_BITRATE (kbit/s) the input can't fit and is split instead.
+# ASSUMED_AUDIO_BITRATE (bits/s) is used when the audio bitrate is not known yet.
+SIZE_TARGET = os.environ.get("SIZE_TARGET", "1") == "1"
+MIN_VIDEO_BITRATE = int(os.environ.get("MIN_VIDEO_BITRATE", 250))
+ASSUMED_AUDIO_BITRATE = int(os.environ.get("ASSUMED_AUDIO_BITRATE", 320000))
+
+# Multi-part uploads: parts whose bytes upload at once, and attempts per part.
+UPLOAD_CONCURRENCY = int(os.environ.get("UPLOAD_CONCURRENCY", 3))
+UPLOAD_ATTEMPTS = int(os.environ.get("UPLOAD_ATTEMPTS", 3))
+
+# Telegram sessions used for downloads and uploads: the bot's own plus TRANSFER_SESSIONS - 1
+# extra logins of the same bot token, each with its own connections and throughput limits.
+TRANSFER_SESSIONS = int(os.environ.get("TRANSFER_SESSIONS", 1))
+
+# Staged downloads: the input is fetched as DOWNLOAD_PARALLEL concurrent byte ranges, each giving up after
+# DOWNLOAD_ATTEMPTS failures in a row. Progress is recorded every DOWNLOAD_CHECKPOINT_MIB MiB and survives
+# a restart in checkpoint dirs.
+DOWNLOAD_PARALLEL = int(os.environ.get("DOWNLOAD_PARALLEL", 4))
+DOWNLOAD_CHECKPOINT_MIB = int(os.environ.get("DOWNLOAD_CHECKPOINT_MIB", 32))
+DOWNLOAD_ATTEMPTS = int(os.environ.get("DOWNLOAD_ATTEMPTS", 3))
+# pyrogram runs at most this many downloads (and, separately, uploads) per client at once; its default is 1,
+# which would serialize the parallel download ranges and the UPLOAD_CONCURRENCY part uploads.
+# A streaming encode holds a download slot for its whole duration, so each encode worker gets one on top.
+MAX_TRANSMISSIONS = int(os.environ.get("MAX_TRANSMISSIONS", max(DOWNLOAD_PARALLEL + ENCODE_WORKERS, UPLOAD_CONCURRENCY)))
+
+# Thumbnails come out of the encode itself. 0 takes the frame at 1s; N > 0 picks the most
+# representative non-black, non-flat frame of the first N seconds instead.
+THUMBNAIL_WINDOW = float(os.environ.get("THUMBNAIL_WINDOW", 0))
+
+# /overlay: the green screen keyed out of overlay clips (ffmpeg colorkey color, similarity, blend).
+OVERLAY_KEY_COLOR = os.environ.get("OVERLAY_KEY_COLOR", "0x00FF00")
+OVERLAY_SIMILARITY = float(os.environ.get("OVERLAY_SIMILARITY", 0.3))
+OVERLAY_BLEND = float(os.environ.get("OVERLAY_BLEND", 0.2))
+# Overlay clips and watermark images reused across jobs, least recently used evicted past the size.
+MEDIA_CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR", os.path.join(SCRATCH_DIR, "wmbot_media_cache"))
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get("MEDIA_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+# /imgwatermark: width of the watermark image as a fraction of the video width.
+IMG_WATERMARK_SCALE = float(os.environ.get("IMG_WATERMARK_SCALE", 0.15))
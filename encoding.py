@@ -0,0 +1,491 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import deque
+
+from config import FFMPEG_PATH, ENCODE_THREADS, PARALLEL_CHUNKS, PROGRESS_LOG_INTERVAL, MIN_VIDEO_BITRATE, THUMBNAIL_WINDOW
+from config import OVERLAY_KEY_COLOR, OVERLAY_SIMILARITY, OVERLAY_BLEND, ENCODER_SLOTS
+from ffprogress import ProgressParser, ProgressSnapshot, EncodeStats
+from media import run_process, remove_tree
+from probe import probe
+
+logger = logging.getLogger(__name__)
+
+_encoder_slots = None
+
+def encoder_slots():
+    """
+    Semaphore shared by every watermark encode in the process (whole-file,
+    part, streaming and chunk encodes alike), so concurrent jobs never run
+    more than ENCODER_SLOTS x264 encoders of ENCODE_THREADS threads each.
+    """
+    global _encoder_slots
+    if _encoder_slots is None:
+        _encoder_slots = asyncio.Semaphore(ENCODER_SLOTS)
+    return _encoder_slots
+
+# ─── Watermark Filter Strings ───
+def build_watermark_filter(state, t_offset=0.0, source="in"):
+    """
+    Build the watermark filter string for the 'watermark'/'harrypotter' and 'watermarktm' modes,
+    the chroma-key composite of state['overlay'] for the 'overlay' mode, or the
+    pre-scaled image state['logo'] in the corner for the 'imgwatermark' mode.
+    With state['sprite'] (see sprites.prepare_watermark) the pre-rendered text is
+    composited with overlay; otherwise drawtext rasterises it on every frame.
+    t_offset is the position of the input within the original video, so a chunk
+    that starts at t_offset continues the moving mod(t,30) animation seamlessly.
+    source is the label of the video input the sprite overlay refers to.
+    """
+    t = f"(t+{t_offset:.6f})" if t_offset else "t"
+    if state['mode'] == 'overlay':
+        # The overlay clip is read, keyed and scaled to the frame inside the same graph;
+        # after it ends the main video continues alone. setpts restarts a seeked clip at 0
+        # to line up with the chunk or part, whose own timestamps start at 0.
+        seek = f":seek_point={t_offset:.6f}" if t_offset else ""
+        return (
+            f"movie={state['overlay']}{seek},setpts=PTS-STARTPTS,colorkey={OVERLAY_KEY_COLOR}:{OVERLAY_SIMILARITY}:{OVERLAY_BLEND},format=yuva420p[key];"
+            f"[key][{source}]scale2ref=w=main_w:h=main_h[keyed][base];"
+            f"[base][keyed]overlay=eof_action=pass"
+        )
+    if state['mode'] == 'imgwatermark':
+        # state['logo'] is already scaled for this video (see sprites.get_logo_sprite).
+        return f"movie={state['logo']}[wm];[{source}][wm]overlay=x=W-w-W/50:y=H-h-W/50"
+    if state.get('sprite'):
+        if state['mode'] == 'watermarktm':
+            x, y = f"mod({t}\\,30)*30", f"mod({t}\\,30)*15"
+        else:
+            x, y = "(W-w)/2", f"(H-h-10)+((10-(H-h-10))*(mod({t}\\,30)/30))"
+        return f"movie={state['sprite']}[wm];[{source}][wm]overlay=x={x}:y={y}"
+    if state['mode'] == 'watermarktm':
+        font_path = "cour.ttf"  # Adjust if necessary.
+        return (
+            f"drawtext=text='{state['watermark_text']}':"
+            f"fontfile={font_path}:"
+            f"fontcolor={state['font_color']}:"
+            f"fontsize={state['font_size']}:"
+            f"font='Courier New':"
+            f"x='mod({t}\\,30)*30':"
+            f"y='mod({t}\\,30)*15'"
+        )
+    return (
+        f"drawtext=text='{state['watermark_text']}':"
+        f"fontcolor={state['font_color']}:"
+        f"fontsize={state['font_size']}:"
+        f"x=(w-text_w)/2:"
+        f"y=(h-text_h-10)+((10-(h-text_h-10))*(mod({t}\\,30)/30))"
+    )
+
+def build_encode_cmd(input_file, output_file, state, t_offset=0.0, audio=True, seek=0.0, size_limit=None, thumbnail=None):
+    """
+    ffmpeg command watermarking input_file into output_file. With thumbnail,
+    a (path, filter) pair from thumbnail_filter, the watermarked frames are
+    also split off to write a JPEG thumbnail as a second output of the same pass.
+    """
+    cmd = [FFMPEG_PATH, "-fflags", "+genpts"]
+    if seek:
+        cmd += ["-ss", f"{seek:.6f}"]
+    cmd += ["-i", input_file]
+    if thumbnail:
+        watermark = build_watermark_filter(state, t_offset, source="0:v")
+        if "[0:v]" not in watermark:
+            watermark = f"[0:v]{watermark}"
+        cmd += [
+            "-filter_complex", f"{watermark},split=2[video][thumb];[thumb]{thumbnail[1]}[thumb_out]",
+            "-map", "[video]",
+        ]
+        if audio:
+            cmd += ["-map", "0:a:0?"]
+    else:
+        cmd += ["-vf", build_watermark_filter(state, t_offset)]
+    cmd += [
+        "-c:v", "libx264", "-crf", str(state.get('crf', 23)), "-preset", state.get('preset', 'medium'),
+        "-threads", str(ENCODE_THREADS),
+        "-movflags", "+faststart",
+        "-pix_fmt", "yuv420p",
+    ]
+    if state.get('maxrate'):
+        # Capped CRF: quality-driven as before, but never above the bitrate that fits the size target.
+        cmd += ["-maxrate", f"{state['maxrate']}k", "-bufsize", f"{state['maxrate'] * 2}k"]
+    cmd += ["-c:a", "copy"] if audio else ["-an"]
+    if size_limit:
+        cmd += ["-fs", str(size_limit)]
+    cmd += ["-progress", "pipe:1", "-y", output_file]
+    if thumbnail:
+        cmd += ["-map", "[thumb_out]", "-frames:v", "1", "-update", "1", "-q:v", "3", thumbnail[0]]
+    return cmd
+
+# ─── Thumbnails from the Encode Pass ───
+# Frames whose luma histogram entropy (0-1) is at most this are black or flat and never picked.
+THUMBNAIL_MIN_ENTROPY = 0.4
+
+def thumbnail_filter(duration_sec, fps):
+    """
+    Filter chain for the thumbnail branch of build_encode_cmd, scaled to
+    Telegram's 320px limit. By default it takes the frame at 1s (mid-way
+    through shorter videos). With THUMBNAIL_WINDOW it takes the most
+    representative frame of the first THUMBNAIL_WINDOW seconds that is
+    neither black nor flat, judged on the downscaled frames.
+    """
+    scale = "scale=320:320:force_original_aspect_ratio=decrease"
+    if THUMBNAIL_WINDOW > 0:
+        window = min(THUMBNAIL_WINDOW, duration_sec) if duration_sec > 0 else THUMBNAIL_WINDOW
+        frames = max(int(window * (fps or 30)), 1)
+        return (
+            f"trim=end={window:.3f},{scale},entropy,"
+            f"metadata=mode=select:key=lavfi.entropy.normalized_entropy.normal.Y:value={THUMBNAIL_MIN_ENTROPY}:function=greater,"
+            f"thumbnail=n={frames}"
+        )
+    at = min(1.0, duration_sec / 2) if duration_sec > 0 else 1.0
+    # Only the first frame from `at` on is passed, so the branch scales a single frame.
+    return f"select='gte(t,{at:.3f})*eq(selected_n,0)',{scale}"
+
+# ─── Size-Targeted Rate Control ───
+def target_video_bitrate(duration_sec, audio_bit_rate, size_limit):
+    """
+    Highest video bitrate in kbit/s at which duration_sec of video plus the
+    audio track fits in size_limit bytes, with a margin for the container and
+    the rate control's overshoot. Returns 0 if that is below MIN_VIDEO_BITRATE.
+    """
+    if duration_sec <= 0:
+        return 0
+    total_kbps = size_limit * 0.97 * 8 / duration_sec / 1000
+    video_kbps = int(total_kbps - audio_bit_rate / 1000)
+    return video_kbps if video_kbps >= MIN_VIDEO_BITRATE else 0
+
+# ─── Running FFmpeg with -progress pipe:1 ───
+async def _feed_stdin(proc, source):
+    try:
+        async for chunk in source:
+            proc.stdin.write(chunk)
+            await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass  # ffmpeg exited early; its return code tells why
+    except Exception as e:
+        # Killed before stdin closes, so ffmpeg never sees EOF and can't finish a truncated output.
+        logger.error(f"Input stream failed: {e}")
+        proc.kill()
+    finally:
+        proc.stdin.close()
+
+async def run_ffmpeg_progress(cmd, on_progress=None, stdin_source=None, stats=None, key=0, label="ffmpeg"):
+    """
+    Run an ffmpeg command that writes -progress to stdout, awaiting
+    on_progress(snapshot) with a ProgressSnapshot for every progress block
+    and recording it in stats (an EncodeStats, under `key`).
+    Progress is logged as a sampled summary every PROGRESS_LOG_INTERVAL
+    seconds; ffmpeg's own log lines only show up if it fails.
+    With stdin_source (an async iterator of bytes) the input is piped to
+    ffmpeg's stdin; use "pipe:0" as the input in cmd.
+    The process is killed if the calling task is cancelled. Returns the return code.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if stdin_source else None,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT
+    )
+    feeder = asyncio.ensure_future(_feed_stdin(proc, stdin_source)) if stdin_source else None
+    parser = ProgressParser()
+    recent = deque(maxlen=20)
+    last_log = time.monotonic()
+    try:
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            decoded_line = line.decode('utf-8', errors='replace').strip()
+            if not ProgressParser.is_progress_line(decoded_line):
+                recent.append(decoded_line)
+                continue
+            snapshot = parser.feed(decoded_line)
+            if snapshot is None:
+                continue
+            if stats:
+                stats.update(key, snapshot)
+            if on_progress:
+                await on_progress(snapshot)
+            now = time.monotonic()
+            if now - last_log >= PROGRESS_LOG_INTERVAL or snapshot.done:
+                last_log = now
+                logger.info(
+                    f"[{label}] out_time={snapshot.out_time:.1f}s fps={snapshot.fps:.1f} "
+                    f"speed={snapshot.speed:.2f}x bitrate={snapshot.bitrate:.0f}kbit/s size={snapshot.total_size}"
+                )
+            if snapshot.done:
+                break
+        await proc.wait()
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    finally:
+        if feeder:
+            feeder.cancel()
+    if proc.returncode != 0:
+        logger.error(f"[{label}] ffmpeg exited with code {proc.returncode}:\n" + "\n".join(recent))
+    return proc.returncode
+
+async def run_ffmpeg(cmd):
+    returncode, _, stderr = await run_process(cmd)
+    if returncode != 0:
+        logger.error(f"ffmpeg failed: {stderr.decode('utf-8', errors='replace')}")
+    return returncode
+
+# ─── Helper: Split Video File by Duration ───
+async def split_video_file(input_file: str, output_dir: str, segment_time: float, segment_list=None) -> list:
+    """
+    Cut input_file into stream-copied parts of roughly segment_time seconds.
+    The segment muxer only cuts at keyframes. With segment_list set, a CSV of
+    "file,start,end" rows (times in the source timeline) is written there too.
+    """
+    output_pattern = os.path.join(output_dir, "part_%03d.mp4")
+    split_cmd = [
+        FFMPEG_PATH,
+        "-i", input_file,
+        "-c", "copy",
+        "-map", "0",
+        "-segment_time", str(segment_time),
+        "-f", "segment",
+        "-reset_timestamps", "1",
+    ]
+    if segment_list:
+        split_cmd += ["-segment_list", segment_list, "-segment_list_type", "csv"]
+    split_cmd.append(output_pattern)
+    if await run_ffmpeg(split_cmd) != 0:
+        logger.error("Error splitting video.")
+        return []
+    parts = sorted([os.path.join(output_dir, f) for f in os.listdir(output_dir) if f.startswith("part_") and f.endswith(".mp4")])
+    return parts
+
+def read_segment_list(segment_list, output_dir):
+    """
+    Parse a csv segment list into [(path, start_sec, end_sec), ...].
+    """
+    segments = []
+    with open(segment_list) as f:
+        for row in f:
+            row = row.strip()
+            if not row:
+                continue
+            name, start, end = row.rsplit(",", 2)
+            segments.append((os.path.join(output_dir, name), float(start), float(end)))
+    return segments
+
+# ─── Checkpoint Manifest for Chunked Encoding ───
+def chunk_fingerprint(input_file, state, segment_time):
+    """
+    Identifies the chunk layout and encode settings a manifest was written for.
+    """
+    settings = [os.path.getsize(input_file), segment_time, build_encode_cmd("in", "out", state, audio=False)]
+    return hashlib.sha1(json.dumps(settings).encode("utf-8")).hexdigest()
+
+def load_manifest(path, fingerprint):
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get("fingerprint") == fingerprint else None
+
+def save_manifest(path, manifest):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+# ─── Keyframe-Chunked Parallel Encoding ───
+# Container bytes allowed per concatenated part on top of its estimated media bytes.
+PART_OVERHEAD = 1024 * 1024
+
+async def encode_chunked(input_file, output_file, state, work_dir, duration_sec, on_progress=None, workers=PARALLEL_CHUNKS,
+                         stats=None, checkpoint=False, thumbnail=None, size_limit=None, on_part=None, audio_bit_rate=0):
+    """
+    Watermark a long video by cutting it at keyframes into chunks, encoding
+    up to `workers` chunks concurrently and concat-demuxing the results.
+    Video is encoded without audio; the original audio is stream-copied in
+    the concat so it stays continuous across chunk borders.
+    With size_limit, finished chunks are grouped in order into parts whose
+    video plus estimated audio (audio_bit_rate bits/s) stays under it, and
+    each part is concatenated and handed to on_part(path, part_duration,
+    index, last) as soon as its chunks are done, while later chunks are
+    still encoding. Like encode_segmented, an output that fits comes out as
+    a single part at output_file.
+    With checkpoint, work_dir/manifest.json records every finished chunk, and
+    a re-run in the same work_dir with the same input and settings only
+    encodes the chunks that are missing; they are left in place on success.
+    A thumbnail (see build_encode_cmd) is written by the first chunk's encode.
+    Returns True on success.
+    """
+    chunk_dir = os.path.join(work_dir, "chunks")
+    encoded_dir = os.path.join(work_dir, "encoded")
+    manifest_path = os.path.join(work_dir, "manifest.json")
+    # Twice as many chunks as workers evens out the uneven keyframe cuts.
+    segment_time = max(duration_sec / (workers * 2), 1)
+    fingerprint = chunk_fingerprint(input_file, state, segment_time)
+    manifest = load_manifest(manifest_path, fingerprint) if checkpoint else None
+    if manifest and all(
+        segment['done'] or os.path.exists(os.path.join(chunk_dir, segment['chunk'])) for segment in manifest['segments']
+    ):
+        done = sum(segment['done'] for segment in manifest['segments'])
+        logger.info(f"Resuming chunked encode from its manifest: {done}/{len(manifest['segments'])} chunks already encoded.")
+    else:
+        await remove_tree(chunk_dir)
+        await remove_tree(encoded_dir)
+        os.makedirs(chunk_dir)
+        os.makedirs(encoded_dir)
+        segment_list = os.path.join(work_dir, "chunks.csv")
+        if not await split_video_file(input_file, chunk_dir, segment_time, segment_list):
+            return False
+        manifest = {
+            "fingerprint": fingerprint,
+            "segments": [
+                {"chunk": os.path.basename(path), "start": start, "end": end, "done": False}
+                for path, start, end in read_segment_list(segment_list, chunk_dir)
+            ],
+        }
+        if checkpoint:
+            save_manifest(manifest_path, manifest)
+    segments = manifest['segments']
+    logger.info(f"Encoding {len(segments)} chunks with {workers} parallel encoders...")
+
+    stats = stats or EncodeStats("chunked", duration_sec)
+    semaphore = asyncio.Semaphore(workers)
+
+    async def chunk_progress(snapshot):
+        if on_progress:
+            await on_progress(stats.out_time)
+
+    async def encode_one(index, segment):
+        chunk_path = os.path.join(chunk_dir, segment['chunk'])
+        encoded_path = os.path.join(encoded_dir, segment['chunk'])
+        if segment['done'] and os.path.exists(encoded_path):
+            stats.update(index, ProgressSnapshot(out_time=segment['end'] - segment['start'], done=True))
+            return encoded_path
+        # Written under a temporary name, so a chunk interrupted mid-encode is never taken as finished.
+        partial_path = encoded_path + ".partial.mp4"
+        async with semaphore, encoder_slots():
+            cmd = build_encode_cmd(
+                chunk_path, partial_path, state, t_offset=segment['start'], audio=False, thumbnail=thumbnail if index == 0 else None
+            )
+            returncode = await run_ffmpeg_progress(cmd, chunk_progress, stats=stats, key=index, label=f"{stats.label} chunk {index}")
+        if returncode != 0:
+            raise RuntimeError(f"chunk {index} failed with return code {returncode}")
+        os.replace(partial_path, encoded_path)
+        os.remove(chunk_path)
+        segment['done'] = True
+        if checkpoint:
+            save_manifest(manifest_path, manifest)
+        return encoded_path
+
+    base, ext = os.path.splitext(output_file)
+    group = []  # (segment, encoded path) of the part being built, in order
+    group_bytes = 0
+    part_index = 1
+
+    def estimated_size(video_bytes, start, end):
+        return PART_OVERHEAD + video_bytes + int(audio_bit_rate / 8 * (end - start))
+
+    async def close_part(last):
+        nonlocal group, group_bytes, part_index
+        part_path = output_file if part_index == 1 else f"{base}_part{part_index:03d}{ext}"
+        start, end = group[0][0]['start'], group[-1][0]['end']
+        concat_list = os.path.join(work_dir, f"concat_{part_index:03d}.txt")
+        with open(concat_list, "w") as f:
+            for _, path in group:
+                f.write(f"file '{path}'\n")
+        audio_input = ["-ss", f"{start:.6f}"] if start else []
+        if not last:
+            audio_input += ["-t", f"{end - start:.6f}"]
+        concat_cmd = [
+            FFMPEG_PATH,
+            "-f", "concat", "-safe", "0", "-i", concat_list,
+            *audio_input, "-i", input_file,
+            "-map", "0:v", "-map", "1:a?",
+            "-c", "copy",
+            "-movflags", "+faststart",
+            "-y", part_path
+        ]
+        if await run_ffmpeg(concat_cmd) != 0:
+            raise RuntimeError(f"concat of part {part_index} failed")
+        os.remove(concat_list)
+        if not checkpoint:
+            for _, path in group:
+                os.remove(path)  # only a checkpointed re-run needs the encoded chunks again
+        if on_part:
+            await on_part(part_path, end - start, part_index, last)
+        group, group_bytes = [], 0
+        part_index += 1
+
+    tasks = [asyncio.ensure_future(encode_one(index, segment)) for index, segment in enumerate(segments)]
+    try:
+        # Chunks finish out of order; parts are built strictly in order as their chunks become ready.
+        for segment, task in zip(segments, tasks):
+            path = await task
+            size = os.path.getsize(path)
+            if group and size_limit and estimated_size(group_bytes + size, group[0][0]['start'], segment['end']) > size_limit:
+                await close_part(False)
+            group.append((segment, path))
+            group_bytes += size
+        await close_part(True)
+    except RuntimeError as e:
+        logger.error(f"Error in chunked encode: {e}")
+        return False
+    finally:
+        for task in tasks:
+            task.cancel()  # stop the remaining chunk encoders after a failure
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    if not checkpoint:
+        await remove_tree(chunk_dir)
+        await remove_tree(encoded_dir)
+    # A checkpoint keeps its chunks and manifest until close_work_dir removes
+    # the directory after the upload, so a restart mid-upload only re-concats.
+    return True
+
+# ─── Size-Capped Encoding into Independently Playable Parts ───
+async def encode_segmented(input_file, output_file, state, duration_sec, size_limit, on_part, on_progress=None, stats=None, thumbnail=None):
+    """
+    Encode with ffmpeg's -fs size cap. If the cap cuts the output short, the
+    next part is encoded from the exact time the previous one stopped (with
+    the drawtext time offset carried over), until the whole input is done.
+    duration_sec and the part boundaries are those of the video stream.
+    on_part(path, part_duration, index, last) is awaited as soon as each part
+    is closed; an output that fits comes out as a single part at output_file.
+    A thumbnail (see build_encode_cmd) is written by the first part's encode.
+    Returns True on success.
+    """
+    base, ext = os.path.splitext(output_file)
+    start = 0.0
+    index = 1
+    while True:
+        part_path = output_file if index == 1 else f"{base}_part{index:03d}{ext}"
+
+        async def part_progress(snapshot):
+            if on_progress:
+                await on_progress(start + snapshot.out_time)
+
+        cmd = build_encode_cmd(
+            input_file, part_path, state, t_offset=start, seek=start, size_limit=size_limit, thumbnail=thumbnail if index == 1 else None
+        )
+        label = f"{stats.label} part {index}" if stats else f"part {index}"
+        async with encoder_slots():
+            returncode = await run_ffmpeg_progress(cmd, part_progress, stats=stats, key=index, label=label)
+        if returncode != 0:
+            return False
+        part_info = await probe(part_path)
+        part_duration = part_info.duration
+        # Boundaries follow the video: audio running past it would otherwise leave an empty last part.
+        if part_info.video_duration <= 0:
+            logger.error(f"Part {index} came out empty.")
+            return False
+        start += part_info.video_duration
+        # Below the cap means ffmpeg reached the end of the input by itself.
+        last = os.path.getsize(part_path) < size_limit or start >= duration_sec - 0.5
+        await on_part(part_path, part_duration, index, last)
+        if last:
+            return True
+        logger.info(f"Part {index} reached the size cap at {start:.2f}s; continuing in a new part.")
+        index += 1
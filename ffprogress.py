@@ -0,0 +1,116 @@
+import time
+import logging
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ProgressSnapshot:
+    frame: int = 0
+    fps: float = 0.0
+    out_time: float = 0.0      # seconds of output written
+    speed: float = 0.0         # multiple of real time
+    bitrate: float = 0.0       # kbit/s
+    total_size: int = 0        # bytes written so far
+    done: bool = False         # progress=end
+
+
+def _number(value, cast=float):
+    # ffmpeg writes "N/A" and suffixes like "1.5x" / "1200.3kbits/s".
+    value = value.strip().rstrip("x").replace("kbits/s", "")
+    try:
+        return cast(value)
+    except ValueError:
+        return cast(0)
+
+
+class ProgressParser:
+    """
+    Turns the key=value lines of ffmpeg's -progress output into snapshots.
+    Every block ends with a progress=continue|end line; feed() returns a
+    snapshot for that line and None for the others.
+    """
+
+    def __init__(self):
+        self._block = {}
+
+    @staticmethod
+    def is_progress_line(line):
+        # Rules out ffmpeg's own log lines, including the -stats line "frame=  12 fps=25 ...".
+        key, sep, value = line.partition("=")
+        return bool(sep) and key.isidentifier() and "=" not in value
+
+    def feed(self, line):
+        key, _, value = line.partition("=")
+        if key != "progress":
+            self._block[key] = value
+            return None
+        block, self._block = self._block, {}
+        # out_time_us is current; older builds only have out_time_ms (also in microseconds).
+        out_time_us = block.get("out_time_us", block.get("out_time_ms", "0"))
+        return ProgressSnapshot(
+            frame=_number(block.get("frame", "0"), int),
+            fps=_number(block.get("fps", "0")),
+            out_time=max(_number(out_time_us, int), 0) / 1000000.0,
+            speed=_number(block.get("speed", "0")),
+            bitrate=_number(block.get("bitrate", "0")),
+            total_size=_number(block.get("total_size", "0"), int),
+            done=value == "end",
+        )
+
+
+class EncodeStats:
+    """
+    Aggregates the snapshots of one job, which may be several ffmpeg
+    processes (chunks or parts, told apart by `key`), into per-job metrics.
+    """
+
+    def __init__(self, label, duration=0.0):
+        self.label = label
+        self.duration = duration
+        self.started = time.monotonic()
+        self.latest = {}
+
+    def update(self, key, snapshot):
+        self.latest[key] = snapshot
+
+    @property
+    def out_time(self):
+        return sum(s.out_time for s in self.latest.values())
+
+    @property
+    def frames(self):
+        return sum(s.frame for s in self.latest.values())
+
+    @property
+    def total_size(self):
+        return sum(s.total_size for s in self.latest.values())
+
+    @property
+    def current_fps(self):
+        return sum(s.fps for s in self.latest.values() if not s.done)
+
+    @property
+    def current_speed(self):
+        return sum(s.speed for s in self.latest.values() if not s.done)
+
+    def summary(self):
+        wall_time = max(time.monotonic() - self.started, 1e-6)
+        return {
+            "label": self.label,
+            "wall_time": round(wall_time, 2),
+            "frames": self.frames,
+            "out_time": round(self.out_time, 2),
+            "avg_fps": round(self.frames / wall_time, 2),
+            "speed": round(self.out_time / wall_time, 3),
+            "total_size": self.total_size,
+        }
+
+    def log_summary(self, ok=True):
+        s = self.summary()
+        logger.info(
+            f"Encode {'finished' if ok else 'FAILED'} [{s['label']}]: {s['out_time']}s of video, "
+            f"{s['frames']} frames in {s['wall_time']}s wall time, avg {s['avg_fps']} fps, "
+            f"speed {s['speed']}x, {s['total_size']} bytes"
+        )
@@ -0,0 +1,94 @@
+import json
+import time
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class JobStore:
+    """
+    Persistent record of submitted jobs, so they survive /restart and crashes.
+
+    A job is stored with its process name, its JSON-serialisable parameters
+    and the ids of the chat messages it needs (which are re-fetched on
+    resume), plus one row per input message with a pending/done/failed
+    status. Jobs are deleted once they finish or are stopped.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " chat_id INTEGER NOT NULL,"
+            " process TEXT NOT NULL,"
+            " label TEXT NOT NULL,"
+            " params TEXT NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS job_items ("
+            " job_id INTEGER NOT NULL,"
+            " message_id INTEGER NOT NULL,"
+            " status TEXT NOT NULL,"
+            " PRIMARY KEY (job_id, message_id))"
+        )
+        self.db.commit()
+
+    def create(self, chat_id, process, label, params, item_ids):
+        """
+        Store a new job and its pending items. Returns the job id.
+        """
+        cursor = self.db.execute(
+            "INSERT INTO jobs (chat_id, process, label, params, created) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, process, label, json.dumps(params), time.time())
+        )
+        job_id = cursor.lastrowid
+        self.db.executemany(
+            "INSERT OR IGNORE INTO job_items (job_id, message_id, status) VALUES (?, ?, 'pending')",
+            [(job_id, message_id) for message_id in item_ids]
+        )
+        self.db.commit()
+        return job_id
+
+    def mark_item(self, job_id, message_id, status):
+        self.db.execute(
+            "UPDATE job_items SET status = ? WHERE job_id = ? AND message_id = ?",
+            (status, job_id, message_id)
+        )
+        self.db.commit()
+
+    def finish(self, job_id):
+        self.db.execute("DELETE FROM job_items WHERE job_id = ?", (job_id,))
+        self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        self.db.commit()
+
+    def finish_chat(self, chat_id):
+        """
+        Forget every stored job of chat_id (used by /stop).
+        """
+        for (job_id,) in self.db.execute("SELECT id FROM jobs WHERE chat_id = ?", (chat_id,)).fetchall():
+            self.finish(job_id)
+
+    def unfinished(self):
+        """
+        Stored jobs in submission order, as dicts with id, chat_id, process,
+        label, params and items ({message_id: status}).
+        """
+        jobs = []
+        for job_id, chat_id, process, label, params in self.db.execute(
+            "SELECT id, chat_id, process, label, params FROM jobs ORDER BY id"
+        ).fetchall():
+            items = dict(self.db.execute(
+                "SELECT message_id, status FROM job_items WHERE job_id = ?", (job_id,)
+            ).fetchall())
+            jobs.append({
+                'id': job_id,
+                'chat_id': chat_id,
+                'process': process,
+                'label': label,
+                'params': json.loads(params),
+                'items': items,
+            })
+        return jobs
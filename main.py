@@ -1,116 +1,55 @@
 import os
 import sys
 import re
+import time
 import asyncio
-import subprocess
 import logging
-import tempfile
-import shutil
 
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.types import Message
 from pyrogram.errors import FloodWait
-from config import BOT_TOKEN, API_ID, API_HASH, FFMPEG_PATH
-from moviepy.editor import VideoFileClip  # Importing MoviePy
+from config import check_bot_config, BOT_TOKEN, API_ID, API_HASH, BULK_QUEUE_SIZE, ENCODE_WORKERS, PARALLEL_CHUNKS, PARALLEL_MIN_DURATION, STREAM_INGEST
+from config import RESULT_CACHE_PATH, RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_AGE, RESULT_CACHE_MAX_BYTES, API_CALLS_PER_SECOND, EDIT_INTERVAL
+from config import METRICS_PATH, METRICS_INTERVAL, JOB_STORE_PATH
+from config import CHECKPOINT_ENCODE, CHECKPOINT_DIR, CHECKPOINT_MIN_DURATION, CHECKPOINT_MAX_AGE
+from config import SIZE_TARGET, ASSUMED_AUDIO_BITRATE, UPLOAD_CONCURRENCY, UPLOAD_ATTEMPTS, TRANSFER_SESSIONS
+from config import SCRATCH_DIR, TEMP_BUDGET, TEMP_RESERVE, FOOTPRINT_FACTOR, SMALL_SCRATCH_DIR, SMALL_SCRATCH_BUDGET, SMALL_JOB_LIMIT
+from config import DOWNLOAD_PARALLEL, DOWNLOAD_CHECKPOINT_MIB, DOWNLOAD_ATTEMPTS, MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES, MAX_TRANSMISSIONS
+from encoding import build_encode_cmd, run_ffmpeg_progress, encoder_slots, encode_chunked, encode_segmented, target_video_bitrate, thumbnail_filter
+from ffprogress import EncodeStats
+from scheduler import JobScheduler
+from notifier import MessageUpdater
+from autotune import choose_profile, calibrate, format_eta
+from sprites import prepare_watermark, get_logo_sprite
+from probe import probe
+from media import generate_thumbnail, remove_tree
+from splitter import split_video_by_size
+from result_cache import ResultCache, make_result_key
+from job_store import JobStore
+from storage import StorageManager
+from uploader import UploadProgress, pre_upload, send_uploaded_video
+from sessions import SessionPool
+from media_cache import MediaCache
+from transfer import get_media, get_media_size, get_media_duration, is_streamable, read_head, iter_media, download_ranged
+import metrics
 
 # ─── Constants ───
 MAX_FILE_SIZE = int(1.90 * (1024 ** 3))  # 1.90 GB in bytes
-
-# ─── Updated Function: Thumbnail Generation using FFmpeg ───
-def generate_thumbnail(video_file, thumbnail_path, time_offset="00:00:01.000"):
-    """
-    Generate a thumbnail image from a video file using FFmpeg.
-    """
-    ffmpeg_executable = FFMPEG_PATH if FFMPEG_PATH else "ffmpeg"
-    # Move -ss before -i for faster seeking
-    command = [
-        ffmpeg_executable,
-        "-ss", time_offset,
-        "-i", video_file,
-        "-frames:v", "1",
-        "-y",  # Overwrite if exists
-        thumbnail_path
-    ]
-    try:
-        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        logging.info("Thumbnail generated successfully.")
-        return thumbnail_path
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Thumbnail generation failed: {e.stderr.decode('utf-8')}")
-        return None
-
-# ─── Updated Function: Retrieve Video Details with MoviePy and ffprobe Fallback ───
-def get_video_details(video_file):
-    """
-    Retrieve video details (width, height, duration).
-    Attempts MoviePy first and falls back to ffprobe if needed.
-    """
-    try:
-        clip = VideoFileClip(video_file)
-        details = {
-            "width": clip.w,
-            "height": clip.h,
-            "duration": clip.duration
-        }
-        clip.reader.close()
-        if clip.audio:
-            clip.audio.reader.close_proc()
-        return details
-    except Exception as e:
-        logging.error(f"MoviePy failed to retrieve details: {e}. Falling back to ffprobe.")
-        try:
-            ffprobe_executable = FFMPEG_PATH.replace("ffmpeg", "ffprobe") if FFMPEG_PATH else "ffprobe"
-            ffprobe_cmd = [
-                ffprobe_executable,
-                "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "stream=width,height,duration",
-                "-of", "default=noprint_wrappers=1:nokey=1",
-                video_file
-            ]
-            result = subprocess.run(ffprobe_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-            output = result.stdout.decode('utf-8').strip().splitlines()
-            if len(output) >= 3:
-                details = {
-                    "width": int(output[0]),
-                    "height": int(output[1]),
-                    "duration": float(output[2])
-                }
-                return details
-            else:
-                logging.error("ffprobe did not return enough data.")
-        except Exception as ex:
-            logging.error(f"ffprobe failed to retrieve details: {ex}")
-        return {}
-
-# ─── Helper Function: Split Video by Size ───
-def split_video_by_size(input_file, output_dir, segment_size):
-    """
-    Split a video file into segments not exceeding segment_size bytes.
-    """
-    output_pattern = os.path.join(output_dir, "part_%03d.mp4")
-    cmd = [
-        FFMPEG_PATH,
-        "-i", input_file,
-        "-c", "copy",
-        "-map", "0",
-        "-f", "segment",
-        "-segment_size", str(segment_size),
-        output_pattern
-    ]
-    try:
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        parts = sorted([os.path.join(output_dir, f) for f in os.listdir(output_dir) if f.startswith("part_") and f.endswith(".mp4")])
-        return parts
-    except subprocess.CalledProcessError as e:
-        logging.error("Error splitting video by size: " + e.stderr.decode('utf-8'))
-        return []
+PART_SIZE_LIMIT = int(MAX_FILE_SIZE * 0.98)  # -fs cap for the media data; leaves room for the moov atom
 
 # ─── Allowed admin IDs ───
 ALLOWED_ADMINS = [640815756, 5317760109, 7511338278]
 
-# ─── Global flag and state dictionaries ───
-processing_active = False
+# ─── Job scheduler, API budget, result cache, job store, temp storage and state dictionaries ───
+scheduler = JobScheduler(ENCODE_WORKERS)
+updater = MessageUpdater(API_CALLS_PER_SECOND, EDIT_INTERVAL)
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES)
+result_cache = ResultCache(RESULT_CACHE_PATH, RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_AGE, RESULT_CACHE_MAX_BYTES)
+job_store = JobStore(JOB_STORE_PATH)
+storage = StorageManager(
+    SCRATCH_DIR, TEMP_BUDGET, TEMP_RESERVE, FOOTPRINT_FACTOR,
+    SMALL_SCRATCH_DIR or None, SMALL_SCRATCH_BUDGET, SMALL_JOB_LIMIT
+)
 user_state = {}
 bulk_state = {}
 
@@ -123,73 +62,155 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ─── Initialize Pyrogram Client ───
-app = Client("watermark_robot_2", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+check_bot_config()
+app = Client(
+    "watermark_robot_2", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN,
+    max_concurrent_transmissions=MAX_TRANSMISSIONS
+)
+# Extra sessions of the same bot that downloads and uploads are spread across.
+sessions = SessionPool(app, TRANSFER_SESSIONS, API_ID, API_HASH, BOT_TOKEN, MAX_TRANSMISSIONS)
 
 # ─── Helper: Check Authorization ───
 async def check_authorization(message: Message) -> bool:
     if message.chat.id not in ALLOWED_ADMINS:
-        await message.reply_text("You are not authorized.")
+        await updater.call(message.reply_text, "You are not authorized.")
         return False
     return True
 
-# ─── Helper: Split Video File by Duration (unchanged) ───
-async def split_video_file(input_file: str, output_dir: str, segment_time: int) -> list:
-    output_pattern = os.path.join(output_dir, "part_%03d.mp4")
-    split_cmd = [
-        FFMPEG_PATH,
-        "-i", input_file,
-        "-c", "copy",
-        "-map", "0",
-        "-segment_time", str(segment_time),
-        "-f", "segment",
-        "-reset_timestamps", "1",
-        output_pattern
-    ]
-    proc = await asyncio.create_subprocess_exec(
-        *split_cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
-    stdout, stderr = await proc.communicate()
-    if proc.returncode != 0:
-        logger.error(f"Error splitting video: {stderr.decode('utf-8')}")
-        return []
-    parts = sorted([os.path.join(output_dir, f) for f in os.listdir(output_dir) if f.startswith("part_") and f.endswith(".mp4")])
-    return parts
+# ─── Helper: Submit a Job to the Scheduler ───
+async def submit_job(client, message: Message, chat_id, label, process, state):
+    """
+    Detach `state` from the conversation dicts (so the chat can set up its next
+    job right away), record it in the job store and queue
+    process(client, message, state, chat_id).
+    """
+    if user_state.get(chat_id) is state:
+        del user_state[chat_id]
+    if bulk_state.get(chat_id) is state:
+        del bulk_state[chat_id]
+    state['job_id'] = job_store.create(chat_id, process.__name__, label, serialize_state(state, message), job_item_ids(state))
+    position = scheduler.submit(chat_id, label, lambda: run_job(process, client, message, state, chat_id))
+    if position > scheduler.idle_workers():
+        await updater.call(message.reply_text, f"All workers are busy. Your job is queued at position {position}; see /queue.")
+
+async def run_job(process, client, message, state, chat_id):
+    try:
+        await process(client, message, state, chat_id)
+    except asyncio.CancelledError:
+        raise  # /stop has already forgotten it; on shutdown it is resumed at the next start
+    except Exception:
+        job_store.finish(state['job_id'])
+        raise
+    job_store.finish(state['job_id'])
+
+# ─── Helpers: Persisting and Resuming Jobs ───
+# Conversation keys that only matter while a job is being set up or running.
+TRANSIENT_KEYS = {'step', 'temp_dir', 'ack_msg', 'job_id'}
+# Messages a single-video job can't run without, by process name.
+JOB_INPUT_KEYS = {
+    'process_watermark': ['video_message'],
+    'process_overlay': ['main_video_message', 'overlay_video_message'],
+    'process_imgwatermark': ['video_message', 'image_message'],
+}
+
+def serialize_state(state, message):
+    """
+    JSON form of a job state: Message values are stored as message ids and
+    re-fetched by restore_state.
+    """
+    params = {}
+    messages = {}
+    for key, value in state.items():
+        if key in TRANSIENT_KEYS:
+            continue
+        if isinstance(value, Message):
+            messages[key] = value.id
+        elif isinstance(value, list) and value and all(isinstance(v, Message) for v in value):
+            messages[key] = [v.id for v in value]
+        else:
+            params[key] = value
+    return {'state': params, 'messages': messages, 'trigger': message.id}
+
+def job_item_ids(state):
+    if state.get('videos'):
+        return [video_msg.id for video_msg in state['videos']]
+    if state.get('video_message'):
+        return [state['video_message'].id]
+    if state.get('main_video_message'):
+        return [state['main_video_message'].id]
+    return []
+
+async def restore_state(client, chat_id, params):
+    """
+    Rebuild a stored job state. Returns (state, trigger message); messages
+    that no longer exist are left out of the state (the trigger becomes None).
+    """
+    ids = [params['trigger']]
+    for value in params['messages'].values():
+        ids += value if isinstance(value, list) else [value]
+    fetched = {}
+    for start in range(0, len(ids), 200):
+        for msg in await updater.call(client.get_messages, chat_id, ids[start:start + 200]):
+            if msg and not msg.empty:
+                fetched[msg.id] = msg
+    state = dict(params['state'], step='processing')
+    for key, value in params['messages'].items():
+        if isinstance(value, list):
+            state[key] = [fetched[message_id] for message_id in value if message_id in fetched]
+        elif value in fetched:
+            state[key] = fetched[value]
+    return state, fetched.get(params['trigger'])
+
+async def resume_jobs(client):
+    """
+    Re-queue the jobs left unfinished by the previous run, skipping videos
+    that were already delivered.
+    """
+    for job in job_store.unfinished():
+        chat_id = job['chat_id']
+        process = RESUMABLE_PROCESSES.get(job['process'])
+        try:
+            state, message = await restore_state(client, chat_id, job['params'])
+        except Exception as e:
+            logger.error(f"Cannot restore job {job['id']} for chat {chat_id}: {e}")
+            job_store.finish(job['id'])
+            continue
+        pending = {message_id for message_id, status in job['items'].items() if status == 'pending'}
+        if 'videos' in state:
+            state['videos'] = [video_msg for video_msg in state['videos'] if video_msg.id in pending]
+            has_input = bool(state['videos'])
+        else:
+            inputs = JOB_INPUT_KEYS.get(job['process'], [])
+            has_input = not job['items'] or (bool(pending) and all(state.get(key) is not None for key in inputs))
+        if process is None or message is None or not has_input:
+            logger.info(f"Dropping stored job {job['id']} ({job['label']}) for chat {chat_id}: nothing left to resume.")
+            job_store.finish(job['id'])
+            continue
+        state['job_id'] = job['id']
+        scheduler.submit(
+            chat_id, job['label'],
+            lambda process=process, message=message, state=state, chat_id=chat_id: run_job(process, client, message, state, chat_id)
+        )
+        left = len(state['videos']) if 'videos' in state else 1
+        logger.info(f"Resumed job {job['id']} ({job['label']}) for chat {chat_id}.")
+        try:
+            await updater.call(client.send_message, chat_id, f"Resuming \"{job['label']}\" after a restart ({left} video(s) left).")
+        except Exception as e:
+            logger.error(f"Error notifying chat {chat_id} about resumed job: {e}")
 
 # ─── Progress Callback Factories ───
+# Edits go through the shared updater, which coalesces them per message and
+# keeps all jobs inside the global API budget. They also feed the transfer byte counters.
 def create_download_progress(client, chat_id, progress_msg: Message):
-    last_update = 0
-    async def progress(current, total):
-        nonlocal last_update
-        if total:
-            percent = (current / total) * 100
-            if percent - last_update >= 5 or percent >= 100:
-                try:
-                    await progress_msg.edit_text(f"Downloading: {percent:.2f}%")
-                    last_update = percent
-                except Exception as e:
-                    if "MESSAGE_NOT_MODIFIED" in str(e):
-                        pass
-                    else:
-                        logger.error("Error updating download progress: " + str(e))
-    return progress
+    last = 0
 
-def create_upload_progress(client, chat_id, progress_msg: Message):
-    last_update = 0
     async def progress(current, total):
-        nonlocal last_update
-        if total:
-            percent = (current / total) * 100
-            if percent - last_update >= 5 or percent >= 100:
-                try:
-                    await progress_msg.edit_text(f"Uploading: {percent:.2f}%")
-                    last_update = percent
-                except Exception as e:
-                    if "MESSAGE_NOT_MODIFIED" in str(e):
-                        pass
-                    else:
-                        logger.error("Error updating upload progress: " + str(e))
+        nonlocal last
+        # Goes back when a download range is retried; its bytes are counted again.
+        metrics.inc("download_bytes_total", max(current - last, 0))
+        last = current
+        if total and progress_msg:
+            updater.edit(progress_msg, f"Downloading: {(current / total) * 100:.0f}%")
     return progress
 
 # ─── Admin Commands ───
@@ -197,18 +218,54 @@ def create_upload_progress(client, chat_id, progress_msg: Message):
 async def stop_cmd(client, message: Message):
     if not await check_authorization(message):
         return
-    global processing_active
-    if processing_active:
-        processing_active = False
-        await message.reply_text("Processing task stopped.")
+    count = scheduler.cancel(message.chat.id)
+    job_store.finish_chat(message.chat.id)
+    if count:
+        await updater.call(message.reply_text, f"Stopped {count} job(s).")
     else:
-        await message.reply_text("No processing task is running.")
+        await updater.call(message.reply_text, "No processing task is running.")
+
+@app.on_message(filters.command("queue") & filters.private)
+async def queue_cmd(client, message: Message):
+    if not await check_authorization(message):
+        return
+    chat_id = message.chat.id
+    running = scheduler.running()
+    pending = scheduler.pending()
+    lines = [f"Workers busy: {len(running)}/{scheduler.workers}. Jobs waiting: {len(pending)}."]
+    for job in running:
+        lines.append(f"▶ {job['label']}" + (" (yours)" if job['chat_id'] == chat_id else ""))
+    for position, job in enumerate(pending, start=1):
+        lines.append(f"{position}. {job['label']}" + (" (yours)" if job['chat_id'] == chat_id else ""))
+    await updater.call(message.reply_text, "\n".join(lines))
+
+@app.on_message(filters.command("calibrate") & filters.private)
+async def calibrate_cmd(client, message: Message):
+    if not await check_authorization(message):
+        return
+    chat_id = message.chat.id
+
+    async def run():
+        work_dir = storage.make_temp_dir()
+        try:
+            table = await calibrate(work_dir)
+        except RuntimeError as e:
+            logger.error(f"Calibration failed: {e}")
+            await updater.call(client.send_message, chat_id, "Calibration failed; the previous throughput table is kept.")
+            return
+        finally:
+            await remove_tree(work_dir)
+        lines = [f"{preset}: {entry['mpix_per_sec']} Mpix/s" for preset, entry in table['presets'].items()]
+        await updater.call(client.send_message, chat_id, "Calibration complete.\n" + "\n".join(lines))
+
+    position = scheduler.submit(chat_id, "calibration", run)
+    await updater.call(message.reply_text, f"Calibration queued at position {position}. It encodes synthetic clips with every preset.")
 
 @app.on_message(filters.command("restart") & filters.private)
 async def restart_cmd(client, message: Message):
     if not await check_authorization(message):
         return
-    await message.reply_text("Bot is restarting...")
+    await updater.call(message.reply_text, "Bot is restarting...")
     os.execv(sys.executable, [sys.executable] + sys.argv)
 
 # ─── Command Handlers for Single-Video Watermark Modes ───
@@ -227,7 +284,7 @@ async def watermark_cmd(client, message: Message):
         'preset': None,
         'step': 'await_video'
     }
-    await message.reply_text("Send video.")
+    await updater.call(message.reply_text, "Send video.")
 
 @app.on_message(filters.command("watermarktm") & filters.private)
 async def watermarktm_cmd(client, message: Message):
@@ -244,7 +301,7 @@ async def watermarktm_cmd(client, message: Message):
         'preset': None,
         'step': 'await_video'
     }
-    await message.reply_text("Send video.")
+    await updater.call(message.reply_text, "Send video.")
 
 @app.on_message(filters.command("harrypotter") & filters.private)
 async def harrypotter_cmd(client, message: Message):
@@ -261,7 +318,7 @@ async def harrypotter_cmd(client, message: Message):
         'preset': "medium",
         'step': 'await_video'
     }
-    await message.reply_text("Harry Potter preset activated. Send video.")
+    await updater.call(message.reply_text, "Harry Potter preset activated. Send video.")
 
 @app.on_message(filters.command("overlay") & filters.private)
 async def overlay_cmd(client, message: Message):
@@ -276,7 +333,7 @@ async def overlay_cmd(client, message: Message):
         'duration': None,
         'step': 'await_main'
     }
-    await message.reply_text("Send the **main video** for overlay.")
+    await updater.call(message.reply_text, "Send the **main video** for overlay.")
 
 @app.on_message(filters.command("imgwatermark") & filters.private)
 async def imgwatermark_cmd(client, message: Message):
@@ -290,7 +347,7 @@ async def imgwatermark_cmd(client, message: Message):
         'temp_dir': None,
         'step': 'await_video'
     }
-    await message.reply_text("Send video for image watermarking.")
+    await updater.call(message.reply_text, "Send video for image watermarking.")
 
 # ─── Bulk Watermarking Commands and Handlers ───
 @app.on_message(filters.command("inputwatermark") & filters.private)
@@ -299,7 +356,7 @@ async def inputwatermark_bulk(client, message: Message):
         return
     chat_id = message.chat.id
     bulk_state[chat_id] = {'videos': []}
-    await message.reply_text("Bulk watermark mode activated.\nNow, send all the videos you want to watermark.")
+    await updater.call(message.reply_text, "Bulk watermark mode activated.\nNow, send all the videos you want to watermark.")
 
 @app.on_message(filters.command("watermarkask") & filters.private)
 async def bulk_watermarkask_cmd(client, message: Message):
@@ -307,11 +364,11 @@ async def bulk_watermarkask_cmd(client, message: Message):
         return
     chat_id = message.chat.id
     if chat_id not in bulk_state or not bulk_state[chat_id].get('videos'):
-        await message.reply_text("No videos collected. Use /inputwatermark first and send your videos.")
+        await updater.call(message.reply_text, "No videos collected. Use /inputwatermark first and send your videos.")
         return
     bulk_state[chat_id]['mode'] = 'watermark'
     bulk_state[chat_id]['step'] = 'await_text'
-    await message.reply_text("Send watermark text for bulk image watermarking.")
+    await updater.call(message.reply_text, "Send watermark text for bulk image watermarking.")
 
 @app.on_message(filters.command("watermarktmask") & filters.private)
 async def bulk_watermarktmask_cmd(client, message: Message):
@@ -319,20 +376,50 @@ async def bulk_watermarktmask_cmd(client, message: Message):
         return
     chat_id = message.chat.id
     if chat_id not in bulk_state or not bulk_state[chat_id].get('videos'):
-        await message.reply_text("No videos collected. Use /inputwatermark first and send your videos.")
+        await updater.call(message.reply_text, "No videos collected. Use /inputwatermark first and send your videos.")
         return
     bulk_state[chat_id]['mode'] = 'watermarktm'
     bulk_state[chat_id]['step'] = 'await_text'
-    await message.reply_text("Send watermark text for bulk text watermarking.")
+    await updater.call(message.reply_text, "Send watermark text for bulk text watermarking.")
+
+@app.on_message(filters.command("imgwatermarkask") & filters.private)
+async def bulk_imgwatermarkask_cmd(client, message: Message):
+    if not await check_authorization(message):
+        return
+    chat_id = message.chat.id
+    if chat_id not in bulk_state or not bulk_state[chat_id].get('videos'):
+        await updater.call(message.reply_text, "No videos collected. Use /inputwatermark first and send your videos.")
+        return
+    bulk_state[chat_id]['mode'] = 'imgwatermark'
+    bulk_state[chat_id]['step'] = 'await_image'
+    await updater.call(message.reply_text, "Send the watermark image for bulk image watermarking (as a file to keep transparency).")
+
+async def accept_bulk_image(message, state):
+    state['image_message'] = message
+    state['step'] = 'await_preset'
+    await updater.call(message.reply_text, "Watermark image received. Now send ffmpeg preset (choose: auto, medium, fast, superfast, ultrafast).")
 
 @app.on_message(filters.private & (filters.video | filters.document))
 async def bulk_video_handler(client, message: Message):
     if not await check_authorization(message):
         return
     chat_id = message.chat.id
-    if chat_id in bulk_state:
-        bulk_state[chat_id].setdefault('videos', []).append(message)
-        await message.reply_text("Video added for bulk watermarking.")
+    if chat_id not in bulk_state:
+        message.continue_propagation()  # Not in bulk mode; let video_handler see it.
+    state = bulk_state[chat_id]
+    if state.get('step') == 'await_image' and is_image_document(message):
+        await accept_bulk_image(message, state)  # an image sent as a file
+        return
+    videos = state.setdefault('videos', [])
+    videos.append(message)
+    # One live-edited summary instead of an acknowledgement per video.
+    if 'ack_msg' in state:
+        updater.edit(state['ack_msg'], f"Videos added for bulk watermarking: {len(videos)}")
+        return
+    state['ack_msg'] = None
+    state['ack_msg'] = await updater.call(message.reply_text, f"Videos added for bulk watermarking: {len(videos)}")
+    if len(videos) > 1:
+        updater.edit(state['ack_msg'], f"Videos added for bulk watermarking: {len(videos)}")
 
 # ─── Bulk Text Handler (with custom thumbnail & caption for bulk mode) ───
 @app.on_message(filters.text & filters.private)
@@ -341,20 +428,20 @@ async def bulk_text_handler(client, message: Message):
         return
     chat_id = message.chat.id
     if chat_id not in bulk_state:
-        return  # Not in bulk mode
+        message.continue_propagation()  # Not in bulk mode; let text_handler see it.
     state = bulk_state[chat_id]
     if state.get('step') == 'await_text':
         state['watermark_text'] = message.text.strip()
         state['step'] = 'await_size'
-        await message.reply_text("Watermark text received. Please send font size (as a number).")
+        await updater.call(message.reply_text, "Watermark text received. Please send font size (as a number).")
     elif state.get('step') == 'await_size':
         try:
             size = int(message.text.strip())
             state['font_size'] = size
             state['step'] = 'await_color'
-            await message.reply_text("Font size received. Now send color choice: 1 for black, 2 for white, 3 for red.")
+            await updater.call(message.reply_text, "Font size received. Now send color choice: 1 for black, 2 for white, 3 for red.")
         except ValueError:
-            await message.reply_text("Invalid font size. Please send a number.")
+            await updater.call(message.reply_text, "Invalid font size. Please send a number.")
     elif state.get('step') == 'await_color':
         choice = message.text.strip()
         if choice == "1":
@@ -366,44 +453,43 @@ async def bulk_text_handler(client, message: Message):
         else:
             state['font_color'] = "white"
         state['step'] = 'await_preset'
-        await message.reply_text("Color received. Now send ffmpeg preset (choose: medium, fast, superfast, ultrafast).")
+        await updater.call(message.reply_text, "Color received. Now send ffmpeg preset (choose: auto, medium, fast, superfast, ultrafast).")
     elif state.get('step') == 'await_preset':
         preset = message.text.strip().lower()
-        if preset not in {"medium", "fast", "superfast", "ultrafast"}:
-            await message.reply_text("Invalid preset. Please send one of: medium, fast, superfast, ultrafast.")
+        if preset not in {"auto", "medium", "fast", "superfast", "ultrafast"}:
+            await updater.call(message.reply_text, "Invalid preset. Please send one of: auto, medium, fast, superfast, ultrafast.")
             return
         state['preset'] = preset
         state['step'] = 'ask_thumbnail'
-        await message.reply_text("Do you want to use a custom thumbnail? (yes/no)")
+        await updater.call(message.reply_text, "Do you want to use a custom thumbnail? (yes/no)")
     elif state.get('step') == 'ask_thumbnail':
         answer = message.text.strip().lower()
         if answer in ['yes', 'y']:
             state['step'] = 'await_thumbnail'
-            await message.reply_text("Please send your custom thumbnail image.")
+            await updater.call(message.reply_text, "Please send your custom thumbnail image.")
         else:
             state['step'] = 'ask_caption'
-            await message.reply_text("Do you want to add a custom extra caption? (yes/no)")
+            await updater.call(message.reply_text, "Do you want to add a custom extra caption? (yes/no)")
     elif state.get('step') == 'ask_caption':
         answer = message.text.strip().lower()
         if answer in ['yes', 'y']:
             state['step'] = 'await_caption'
-            await message.reply_text("Please send your custom extra caption text.")
+            await updater.call(message.reply_text, "Please send your custom extra caption text.")
         else:
             state['step'] = 'processing'
-            await message.reply_text("All inputs collected. Bulk watermarking started.")
-            await process_bulk_watermark(client, message, state, chat_id)
+            await updater.call(message.reply_text, "All inputs collected. Bulk watermarking started.")
+            await submit_job(client, message, chat_id, f"bulk {state['mode']} ({len(state['videos'])} videos)", process_bulk_watermark, state)
     elif state.get('step') == 'await_caption':
         state['custom_caption'] = message.text.strip()
         state['step'] = 'processing'
-        await message.reply_text("Custom caption received. Bulk watermarking started.")
-        await process_bulk_watermark(client, message, state, chat_id)
+        await updater.call(message.reply_text, "Custom caption received. Bulk watermarking started.")
+        await submit_job(client, message, chat_id, f"bulk {state['mode']} ({len(state['videos'])} videos)", process_bulk_watermark, state)
 
 # ─── Existing Video Handler for Single Processing ───
 @app.on_message(filters.private & (filters.video | filters.document))
 async def video_handler(client, message: Message):
     if not await check_authorization(message):
         return
-    global processing_active
     chat_id = message.chat.id
     if chat_id not in user_state:
         return
@@ -414,45 +500,48 @@ async def video_handler(client, message: Message):
             return
         state['video_message'] = message
         state['step'] = 'await_text'
-        await message.reply_text("Video captured. Now send the watermark text.")
+        await updater.call(message.reply_text, "Video captured. Now send the watermark text.")
     elif mode == 'harrypotter':
-        if processing_active:
-            await message.reply_text("A process is already running; please try later.")
-            return
         state['video_message'] = message
         state['step'] = 'processing'
-        await message.reply_text("Video captured. Watermarking started.")
-        processing_active = True
-        try:
-            await process_watermark(client, message, state, chat_id)
-        finally:
-            processing_active = False
+        await updater.call(message.reply_text, "Video captured. Watermarking started.")
+        await submit_job(client, message, chat_id, "harrypotter", process_watermark, state)
     elif mode == 'overlay':
         if state.get('step') == 'await_main':
             state['main_video_message'] = message
             state['step'] = 'await_overlay'
-            await message.reply_text("Main video received. Now send the **overlay video** (with green screen background).")
+            await updater.call(message.reply_text, "Main video received. Now send the **overlay video** (with green screen background).")
+        elif state.get('step') == 'await_overlay':
+            state['overlay_video_message'] = message
+            state['step'] = 'processing'
+            await updater.call(message.reply_text, "Overlay video received. Overlay processing started.")
+            await submit_job(client, message, chat_id, "overlay", process_overlay, state)
     elif mode == 'imgwatermark':
+        if state.get('step') == 'await_image' and is_image_document(message):
+            await accept_image(client, message, state, chat_id)  # an image sent as a file
+            return
         if state.get('step') != 'await_video':
             return
         state['video_message'] = message
         state['step'] = 'await_image'
-        await message.reply_text("Video received. Now send the watermark image.")
+        await updater.call(message.reply_text, "Video received. Now send the watermark image.")
 
 # ─── Updated Image Handler for Custom Thumbnail (Single & Bulk) and /imgwatermark ───
 @app.on_message(filters.private & (filters.photo | filters.document))
 async def image_handler(client, message: Message):
     if not await check_authorization(message):
         return
-    global processing_active
     chat_id = message.chat.id
     # Handle bulk mode custom thumbnail first
     if chat_id in bulk_state:
         bulk_state_obj = bulk_state[chat_id]
+        if bulk_state_obj.get('step') == 'await_image':
+            await accept_bulk_image(message, bulk_state_obj)
+            return
         if bulk_state_obj.get('step') == 'await_thumbnail':
             bulk_state_obj['custom_thumbnail'] = message
             bulk_state_obj['step'] = 'ask_caption'
-            await message.reply_text("Custom thumbnail received. Do you want to add a custom extra caption? (yes/no)")
+            await updater.call(message.reply_text, "Custom thumbnail received. Do you want to add a custom extra caption? (yes/no)")
             return
     # Then handle single mode custom thumbnail
     if chat_id not in user_state:
@@ -461,27 +550,22 @@ async def image_handler(client, message: Message):
     if state.get('step') == 'await_thumbnail':
         state['custom_thumbnail'] = message
         state['step'] = 'ask_caption'
-        await message.reply_text("Custom thumbnail received. Do you want to add a custom extra caption? (yes/no)")
+        await updater.call(message.reply_text, "Custom thumbnail received. Do you want to add a custom extra caption? (yes/no)")
         return
     if state.get('mode') == 'imgwatermark' and state.get('step') == 'await_image':
-        state['image_message'] = message
-        state['step'] = 'processing'
-        await message.reply_text("Image received. Processing video with image watermark, please wait...")
-        if processing_active:
-            await message.reply_text("A process is already running; please try later.")
-            return
-        processing_active = True
-        try:
-            await process_imgwatermark(client, message, state, chat_id)
-        finally:
-            processing_active = False
+        await accept_image(client, message, state, chat_id)
+
+async def accept_image(client, message, state, chat_id):
+    state['image_message'] = message
+    state['step'] = 'processing'
+    await updater.call(message.reply_text, "Image received. Processing video with image watermark, please wait...")
+    await submit_job(client, message, chat_id, "imgwatermark", process_imgwatermark, state)
 
 # ─── Updated Text Handler for Single Processing (Custom Thumbnail & Caption) ───
 @app.on_message(filters.text & filters.private)
 async def text_handler(client, message: Message):
     if not await check_authorization(message):
         return
-    global processing_active
     chat_id = message.chat.id
     if chat_id not in user_state:
         return
@@ -492,15 +576,15 @@ async def text_handler(client, message: Message):
         if current_step == 'await_text':
             state['watermark_text'] = message.text.strip()
             state['step'] = 'await_size'
-            await message.reply_text("Watermark text received. Please send font size (as a number).")
+            await updater.call(message.reply_text, "Watermark text received. Please send font size (as a number).")
         elif current_step == 'await_size':
             try:
                 size = int(message.text.strip())
                 state['font_size'] = size
                 state['step'] = 'await_color'
-                await message.reply_text("Font size received. Now send color choice: 1 for black, 2 for white, 3 for red.")
+                await updater.call(message.reply_text, "Font size received. Now send color choice: 1 for black, 2 for white, 3 for red.")
             except ValueError:
-                await message.reply_text("Invalid font size. Please send a number.")
+                await updater.call(message.reply_text, "Invalid font size. Please send a number.")
         elif current_step == 'await_color':
             choice = message.text.strip()
             if choice == "1":
@@ -512,501 +596,823 @@ async def text_handler(client, message: Message):
             else:
                 state['font_color'] = "white"
             state['step'] = 'await_preset'
-            await message.reply_text("Color received. Now send ffmpeg preset (choose: medium, fast, superfast, ultrafast).")
+            await updater.call(message.reply_text, "Color received. Now send ffmpeg preset (choose: auto, medium, fast, superfast, ultrafast).")
         elif current_step == 'await_preset':
             preset = message.text.strip().lower()
-            if preset not in {"medium", "fast", "superfast", "ultrafast"}:
-                await message.reply_text("Invalid preset. Please send one of: medium, fast, superfast, ultrafast.")
+            if preset not in {"auto", "medium", "fast", "superfast", "ultrafast"}:
+                await updater.call(message.reply_text, "Invalid preset. Please send one of: auto, medium, fast, superfast, ultrafast.")
                 return
             state['preset'] = preset
             state['step'] = 'ask_thumbnail'
-            await message.reply_text("Do you want to use a custom thumbnail? (yes/no)")
+            await updater.call(message.reply_text, "Do you want to use a custom thumbnail? (yes/no)")
         elif current_step == 'ask_thumbnail':
             answer = message.text.strip().lower()
             if answer in ['yes', 'y']:
                 state['step'] = 'await_thumbnail'
-                await message.reply_text("Please send your custom thumbnail image.")
+                await updater.call(message.reply_text, "Please send your custom thumbnail image.")
             else:
                 state['step'] = 'ask_caption'
-                await message.reply_text("Do you want to add a custom extra caption? (yes/no)")
+                await updater.call(message.reply_text, "Do you want to add a custom extra caption? (yes/no)")
         elif current_step == 'ask_caption':
             answer = message.text.strip().lower()
             if answer in ['yes', 'y']:
                 state['step'] = 'await_caption'
-                await message.reply_text("Please send your custom extra caption text.")
+                await updater.call(message.reply_text, "Please send your custom extra caption text.")
             else:
                 state['step'] = 'processing'
-                await message.reply_text("All inputs collected. Watermarking started.")
-                processing_active = True
-                try:
-                    await process_watermark(client, message, state, chat_id)
-                finally:
-                    processing_active = False
+                await updater.call(message.reply_text, "All inputs collected. Watermarking started.")
+                await submit_job(client, message, chat_id, mode, process_watermark, state)
         elif current_step == 'await_caption':
             state['custom_caption'] = message.text.strip()
             state['step'] = 'processing'
-            await message.reply_text("Custom caption received. Watermarking started.")
-            processing_active = True
-            try:
-                await process_watermark(client, message, state, chat_id)
-            finally:
-                processing_active = False
+            await updater.call(message.reply_text, "Custom caption received. Watermarking started.")
+            await submit_job(client, message, chat_id, mode, process_watermark, state)
     elif mode == 'harrypotter':
         pass
     elif mode == 'overlay':
         pass
 
-# ─── Helper Function: Get Video Duration Using ffprobe ───
-async def get_video_duration(file_path):
-    proc = await asyncio.create_subprocess_exec(
-        "ffprobe", "-v", "error",
-        "-show_entries", "format=duration",
-        "-of", "default=noprint_wrappers=1:nokey=1",
-        file_path,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
+# ─── Helpers Shared by Single and Bulk Processing ───
+def get_input_file_name(video_msg):
+    if video_msg.video:
+        return video_msg.video.file_name or f"{video_msg.video.file_id}.mp4"
+    elif video_msg.document:
+        return video_msg.document.file_name or f"{video_msg.document.file_id}.mp4"
+    return "input_video.mp4"
+
+def is_image_document(message):
+    return bool(message.document and (message.document.mime_type or "").startswith("image/"))
+
+def get_image_media(image_msg):
+    return image_msg.photo or image_msg.document
+
+def build_caption(video_msg, state, default_caption):
+    caption = video_msg.caption if video_msg.caption else default_caption
+    if 'custom_caption' in state:
+        caption += "\n\n" + state['custom_caption']
+    return caption
+
+# ─── Result Cache: Reuse Uploaded Outputs by file_id ───
+def result_key(video_msg, state, default_caption):
+    thumb_msg = state.get('custom_thumbnail')
+    thumb_media = (thumb_msg.photo or thumb_msg.document) if thumb_msg else None
+    return make_result_key(
+        source=get_media(video_msg).file_unique_id,
+        mode=state['mode'],
+        text=state.get('watermark_text'),
+        size=state.get('font_size'),
+        color=state.get('font_color'),
+        preset=state.get('preset'),
+        thumbnail=thumb_media.file_unique_id if thumb_media else None,
+        overlay=get_media(state['overlay_video_message']).file_unique_id if state.get('overlay_video_message') else None,
+        image=get_image_media(state['image_message']).file_unique_id if state.get('image_message') else None,
+        caption=build_caption(video_msg, state, default_caption),
     )
-    stdout, _ = await proc.communicate()
+
+async def send_cached_result(client, chat_id, parts):
+    """
+    Re-send previously uploaded parts by file_id. Returns False if Telegram refused them.
+    """
     try:
-        duration = float(stdout.decode().strip())
+        for part in parts:
+            await updater.call(client.send_video, chat_id, video=part['file_id'], caption=part['caption'])
+        return True
     except Exception as e:
-        logger.error("Error getting format duration: " + str(e))
-        duration = 0.0
-    if duration < 60:
-        proc2 = await asyncio.create_subprocess_exec(
-            "ffprobe", "-v", "error",
-            "-select_streams", "v:0",
-            "-show_entries", "stream=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-            file_path,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+        logger.error(f"Error re-sending cached result for chat {chat_id}: {e}")
+        return False
+
+def store_result(item):
+    sent = item.get('sent')
+    if sent and 'encode_error' not in item and all(part['file_id'] for part in sent):
+        size = sum(part.pop('size') for part in sent)
+        result_cache.put(item['result_key'], sent, size)
+
+async def edit_progress(item, text):
+    updater.edit(item.get('progress_msg'), text)
+
+async def run_stages(*stages):
+    """
+    Run pipeline stages concurrently and return their results. If one
+    raises, the others are cancelled (which kills their ffmpeg and transfers)
+    and awaited before the error propagates, so nothing is still writing to
+    the work directory when the caller removes it.
+    """
+    tasks = [asyncio.ensure_future(stage) for stage in stages]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# ─── Work Directories: Temporary or Checkpointed ───
+_active_checkpoints = set()  # names of the checkpoint directories in use
+
+async def open_work_dir(client, chat_id, item):
+    """
+    Reserve temp space for the item (waiting for it if the scratch budget is
+    taken) and set item['temp_dir'] and item['checkpoint']. With
+    CHECKPOINT_ENCODE the item works in a persistent directory named after its
+    result key, so a re-run of the same input and settings picks up the
+    downloaded input and the encoded chunks of an earlier attempt. A fresh
+    temp dir is used when checkpointing is off or another job is already
+    using that directory.
+    """
+    name = item['result_key'][:32]
+    checkpoint = CHECKPOINT_ENCODE and name not in _active_checkpoints
+    if checkpoint:
+        _active_checkpoints.add(name)
+
+    async def on_wait():
+        await updater.call(client.send_message, chat_id, "Waiting for temp disk space; the job starts as soon as running jobs free some.")
+
+    try:
+        item['reservation'] = await storage.reserve(
+            get_media_size(item['video_msg']), on_wait, storage.large if checkpoint else None
         )
-        stdout2, _ = await proc2.communicate()
-        try:
-            stream_duration = float(stdout2.decode().strip())
-            duration = max(duration, stream_duration)
-        except Exception as e:
-            logger.error("Error getting stream duration: " + str(e))
-    return duration
+    except BaseException:
+        if checkpoint:
+            _active_checkpoints.discard(name)
+        raise
+    item['checkpoint'] = checkpoint
+    if checkpoint:
+        item['temp_dir'] = os.path.join(CHECKPOINT_DIR, name)
+        os.makedirs(item['temp_dir'], exist_ok=True)
+        os.utime(item['temp_dir'])  # sweep_checkpoints ages directories from their last use
+    else:
+        item['temp_dir'] = storage.make_temp_dir(item['reservation'])
+    return item['temp_dir']
 
-# ─── Processing Function for Single Watermark ───
-async def process_watermark(client, message, state, chat_id):
+async def close_work_dir(item, keep=False):
+    """
+    Release the item's temp space reservation and remove its work directory,
+    unless it is a checkpoint to keep for a re-run.
+    """
+    await storage.release(item.pop('reservation', None))
+    if item['checkpoint']:
+        _active_checkpoints.discard(os.path.basename(item['temp_dir']))
+        if keep:
+            return
+    await remove_tree(item['temp_dir'])
+
+def discard_file(path):
+    """
+    Delete an intermediate file as soon as it is no longer needed.
+    """
     try:
-        progress_msg = await client.send_message(chat_id, "Downloading: 0%")
+        os.remove(path)
+    except OSError:
+        pass
+
+async def sweep_checkpoints():
+    """
+    Remove checkpoint directories not used for CHECKPOINT_MAX_AGE seconds.
+    """
+    if not os.path.isdir(CHECKPOINT_DIR):
+        return
+    cutoff = time.time() - CHECKPOINT_MAX_AGE
+    for entry in os.scandir(CHECKPOINT_DIR):
+        if entry.is_dir() and entry.stat().st_mtime < cutoff and entry.name not in _active_checkpoints:
+            logger.info(f"Removing stale checkpoint {entry.path}")
+            await remove_tree(entry.path)
+
+# ─── Processing Stages: Download → Encode → Upload ───
+async def download_stage(client, chat_id, item, done_text="Download complete. Watermarking started.", allow_stream=False):
+    """
+    Download item['video_msg'] into item['temp_dir'] and set item['input_file'].
+    With allow_stream, a streamable input of known duration that the plain
+    encoder will handle is not staged: item['stream_head'] keeps its first chunk and encode_stage
+    pipes the download straight into ffmpeg.
+    """
+    try:
+        item['progress_msg'] = await updater.call(client.send_message, chat_id, "Downloading: 0%")
     except FloodWait:
-        progress_msg = None
-    temp_dir = tempfile.mkdtemp()
-    state['temp_dir'] = temp_dir
-    video_msg = state['video_message']
-    if video_msg.video:
-        file_name = video_msg.video.file_name or f"{video_msg.video.file_id}.mp4"
-    elif video_msg.document:
-        file_name = video_msg.document.file_name or f"{video_msg.document.file_id}.mp4"
-    else:
-        file_name = "input_video.mp4"
-    input_file_path = os.path.join(temp_dir, file_name)
-    download_cb = create_download_progress(client, chat_id, progress_msg) if progress_msg else None
-    logger.info("Starting video download...")
-    await video_msg.download(file_name=input_file_path, progress=download_cb)
-    logger.info("Video download completed.")
-    if progress_msg:
+        item['progress_msg'] = None
+    video_msg = item['video_msg']
+    item['input_file'] = os.path.join(item['temp_dir'], get_input_file_name(video_msg))
+    # Documents usually report no duration; a long one must be staged to reach the chunked encoder.
+    duration = get_media_duration(video_msg)
+    if allow_stream and STREAM_INGEST and duration and not uses_chunked_encode(duration, item['checkpoint']) \
+            and not os.path.exists(item['input_file']):
         try:
-            await progress_msg.edit_text("Download complete. Watermarking started.")
+            async with sessions.acquire() as session:
+                head = await read_head(session.client, video_msg)
         except FloodWait:
-            progress_msg = None
-    duration_sec = await get_video_duration(input_file_path)
+            head = b""  # that session is paused now; the ranged download uses the others
+        if is_streamable(head):
+            logger.info("Input is streamable; encoding while downloading.")
+            item['stream_head'] = head
+            return
+        logger.info("Input needs seeking; using a staged download.")
+    await fetch_input(client, chat_id, item)
+    await edit_progress(item, done_text)
+
+async def fetch_input(client, chat_id, item):
+    # download_ranged only moves a download to its final name once it is complete.
+    if os.path.exists(item['input_file']) and os.path.getsize(item['input_file']) == get_media_size(item['video_msg']):
+        logger.info("Input already downloaded by an earlier attempt.")
+        return
+    download_cb = create_download_progress(client, chat_id, item['progress_msg'])
+    logger.info("Starting video download...")
+    with metrics.timed("download"):
+        await download_ranged(
+            sessions, item['video_msg'], item['input_file'],
+            DOWNLOAD_PARALLEL, DOWNLOAD_CHECKPOINT_MIB, download_cb, DOWNLOAD_ATTEMPTS
+        )
+    logger.info("Video download completed.")
+
+def uses_chunked_encode(duration_sec, checkpoint=False):
+    if checkpoint and duration_sec >= CHECKPOINT_MIN_DURATION:
+        return True
+    return PARALLEL_CHUNKS > 1 and duration_sec >= PARALLEL_MIN_DURATION
+
+async def encode_streaming(client, state, item, output_file):
+    """
+    Encode while downloading: pipe the Telegram media stream into ffmpeg's stdin.
+    Progress follows the bytes fed, which ffmpeg consumes at encoding speed.
+    """
+    total = get_media_size(item['video_msg'])
+    last_logged = 0
+    last_done = 0
+
+    async def on_chunk(done):
+        nonlocal last_logged, last_done
+        metrics.inc("download_bytes_total", done - last_done)
+        last_done = done
+        if not total:
+            return
+        current_percent = min(done / total * 100, 100)
+        if current_percent - last_logged >= 5 or current_percent == 100:
+            last_logged = current_percent
+            await edit_progress(item, f"Downloading and watermarking: {current_percent:.0f}% completed" + item.get('profile_note', ''))
+
+    thumbnail = encode_thumbnail(state, item, get_media_duration(item['video_msg']), 0)
+    cmd = build_encode_cmd("pipe:0", output_file, state, thumbnail=thumbnail)
+    logger.info("Starting streaming watermarking process...")
+    stats = item['encode_stats']
+    async with encoder_slots(), sessions.acquire() as session:
+        source = iter_media(session.client, item['video_msg'], item['stream_head'], on_chunk)
+        if await run_ffmpeg_progress(cmd, stdin_source=source, stats=stats, label=stats.label) != 0:
+            return False
+    # Nothing was staged, so the encoded file is the only thing to probe.
+    item['media_info'] = await probe(output_file)
+    return True
+
+async def encode_stage(client, chat_id, state, item):
+    """
+    Watermark item['input_file'] and put the finished parts on item['parts']
+    (see queue_part) as soon as each one is closed, followed by None.
+    On failure item['encode_error'] holds the message for the user.
+    Returns True on success.
+    """
+    ok = False
+    item['encode_stats'] = EncodeStats(f"{state['mode']} {get_input_file_name(item['video_msg'])}")
+    metrics.track_encode(item['encode_stats'])
+    try:
+        with metrics.timed("encode"):
+            ok = await encode_output(client, chat_id, state, item)
+        if ok:
+            discard_file(item['input_file'])
+        return ok
+    finally:
+        metrics.untrack_encode(item['encode_stats'])
+        item['encode_stats'].log_summary(ok)
+        if not ok:
+            item.setdefault('encode_error', "Error processing watermarked video.")
+        item['parts'].put_nowait(None)
+
+def queue_part(item, path, duration, index, total):
+    """
+    Hand a closed part to the upload stage. total is None while later parts are still encoding.
+    """
+    item['parts'].put_nowait({'path': path, 'duration': duration, 'index': index, 'total': total})
+
+async def encode_output(client, chat_id, state, item):
+    """
+    Streamable inputs are encoded while downloading and split afterwards if
+    too big. Long inputs go through the keyframe-chunked parallel encoder,
+    which concatenates finished chunks into size-bounded parts while later
+    chunks are still encoding. Everything else is encoded with a size cap, so
+    oversized outputs come out as independently playable parts while the
+    encode is still running.
+    With SIZE_TARGET every path caps the video bitrate (see apply_size_target),
+    so splitting only happens for inputs that can't fit in one upload.
+    """
+    input_file_path = item['input_file']
+    item['base_name'] = os.path.splitext(os.path.basename(input_file_path))[0]
+    output_file = os.path.join(item['temp_dir'], f"{item['base_name']}_watermarked.mp4")
+    state = await prepare_watermark(state)
+    if 'stream_head' in item:
+        video = item['video_msg'].video
+        width, height = (video.width, video.height) if video else (0, 0)
+        streaming_state = await prepare_logo(state, width, height)
+        streaming_state = await resolve_profile(item, streaming_state, width, height, get_media_duration(item['video_msg']), 0)
+        # Nothing is probed before a streaming encode, so the audio bitrate is assumed.
+        streaming_state = apply_size_target(item, streaming_state, get_media_duration(item['video_msg']), ASSUMED_AUDIO_BITRATE)
+        ok = await encode_streaming(client, streaming_state, item, output_file)
+        del item['stream_head']
+        if ok:
+            return await queue_output(item, output_file)
+        logger.error("Streaming watermark failed; retrying with a staged download.")
+        await fetch_input(client, chat_id, item)
+        await edit_progress(item, "Download complete. Watermarking started.")
+    item['media_info'] = await probe(input_file_path)
+    duration_sec = item['media_info'].duration
     if duration_sec <= 0:
         duration_sec = 1  # safeguard
-    base_name = os.path.splitext(os.path.basename(input_file_path))[0]
-    if state['mode'] == 'watermarktm':
-        font_path = "cour.ttf"  # Adjust if necessary.
-    else:
-        font_path = "/usr/share/fonts/truetype/consola.ttf"  # Adjust if needed.
-    if state['mode'] in ['watermark', 'harrypotter']:
-        filter_str = (
-            f"drawtext=text='{state['watermark_text']}':"
-            f"fontcolor={state['font_color']}:" 
-            f"fontsize={state['font_size']}:" 
-            f"x=(w-text_w)/2:" 
-            f"y=(h-text_h-10)+((10-(h-text_h-10))*(mod(t\\,30)/30))"
-        )
-    elif state['mode'] == 'watermarktm':
-        filter_str = (
-            f"drawtext=text='{state['watermark_text']}':"
-            f"fontfile={font_path}:" 
-            f"fontcolor={state['font_color']}:" 
-            f"fontsize={state['font_size']}:" 
-            f"font='Courier New':"
-            f"x='mod(t\\,30)*30':"
-            f"y='mod(t\\,30)*15'"
+    width, height = item['media_info'].display_size()
+    chunked = uses_chunked_encode(duration_sec, item['checkpoint'])
+    parallel = PARALLEL_CHUNKS if chunked else 1
+    state = await prepare_logo(state, width, height)
+    state = await resolve_profile(item, state, width, height, duration_sec, item['media_info'].fps, parallel)
+    info = item['media_info']
+    audio_bit_rate = info.audio_bit_rate or (ASSUMED_AUDIO_BITRATE if info.audio_codec else 0)
+    state = apply_size_target(item, state, duration_sec, audio_bit_rate)
+    last_logged = 0
+
+    async def on_progress(current_sec):
+        nonlocal last_logged
+        current_percent = min((current_sec / duration_sec) * 100, 100)
+        if current_percent - last_logged >= 5 or current_percent == 100:
+            last_logged = current_percent
+            await edit_progress(item, f"Watermark processing: {current_percent:.0f}% completed" + item.get('profile_note', ''))
+
+    thumbnail = encode_thumbnail(state, item, duration_sec, info.fps)
+    if chunked:
+        logger.info("Starting chunked parallel watermarking process...")
+        return await encode_chunked(
+            input_file_path, output_file, state, item['temp_dir'], duration_sec, on_progress,
+            stats=item['encode_stats'], checkpoint=item['checkpoint'], thumbnail=thumbnail,
+            size_limit=PART_SIZE_LIMIT, on_part=chunked_part_handler(item), audio_bit_rate=audio_bit_rate
         )
-    output_file = os.path.join(temp_dir, f"{base_name}_watermarked.mp4")
-    ffmpeg_cmd = [
-        FFMPEG_PATH,
-        "-fflags", "+genpts",
-        "-i", input_file_path,
-        "-vf", filter_str,
-        "-c:v", "libx264", "-crf", "23", "-preset", state.get('preset', 'medium'),
-        "-movflags", "+faststart",
-        "-pix_fmt", "yuv420p",
-        "-c:a", "copy",
-        "-progress", "pipe:1",
-        output_file
-    ]
+
+    async def on_part(path, part_duration, index, last):
+        if index == 2 and item.get('size_target'):
+            logger.warning(f"Output overshot the size target at {item['size_target']} kbit/s; continuing in parts.")
+        queue_part(item, path, part_duration, index, index if last else None)
+
     logger.info("Starting watermarking process...")
-    proc = await asyncio.create_subprocess_exec(
-        *ffmpeg_cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.STDOUT
+    return await encode_segmented(
+        input_file_path, output_file, state, info.video_duration or duration_sec, PART_SIZE_LIMIT, on_part, on_progress,
+        stats=item['encode_stats'], thumbnail=thumbnail
     )
-    last_logged = 0
-    while True:
-        line = await proc.stdout.readline()
-        if not line:
-            break
-        decoded_line = line.decode('utf-8').strip()
-        logger.info(decoded_line)
-        if decoded_line.startswith("out_time_ms="):
-            try:
-                out_time_val = int(decoded_line.split("=")[1])
-                current_sec = out_time_val / 1000000.0
-                current_percent = (current_sec / duration_sec) * 100
-                if current_percent > 100:
-                    current_percent = 100
-                if current_percent - last_logged >= 5 or current_percent == 100:
-                    last_logged = current_percent
-                    if progress_msg:
-                        try:
-                            await progress_msg.edit_text(f"Watermark processing: {current_percent:.0f}% completed")
-                        except FloodWait:
-                            progress_msg = None
-            except Exception as e:
-                logger.error("Error parsing ffmpeg progress: " + str(e))
-        if decoded_line == "progress=end":
-            break
-    await proc.wait()
-    if proc.returncode != 0:
-        logger.error(f"Error processing watermark. Return code: {proc.returncode}")
-        await message.reply_text("Error processing watermarked video.")
-        shutil.rmtree(temp_dir)
-        if chat_id in user_state:
-            del user_state[chat_id]
-        return
 
-    # Retrieve metadata and generate/upload thumbnail:
-    metadata = get_video_details(output_file)
-    width = metadata.get("width", 0)
-    height = metadata.get("height", 0)
-    duration_value = int(metadata.get("duration", 0))
-    thumb_path = os.path.join(temp_dir, f"{base_name}_thumbnail.jpg")
-    # Use the custom thumbnail if provided; otherwise, generate one.
+def chunked_part_handler(item):
+    """
+    on_part for encode_chunked: queue each part as soon as it is concatenated.
+    A part whose size estimate fell short is split before it is queued, so
+    the part numbers handed to the upload stage are renumbered as they go.
+    """
+    queued = 0
+
+    async def on_part(path, part_duration, index, last):
+        nonlocal queued
+        if index == 2 and item.get('size_target'):
+            logger.warning(f"Output overshot the size target at {item['size_target']} kbit/s; continuing in parts.")
+        pieces = [(path, part_duration)]
+        if os.path.getsize(path) > MAX_FILE_SIZE:
+            logger.warning(f"Part {index} came out above the upload limit; splitting it.")
+            split_dir = os.path.join(item['temp_dir'], f"split_{index:03d}")
+            os.makedirs(split_dir, exist_ok=True)
+            paths = await split_video_by_size(path, split_dir, MAX_FILE_SIZE)
+            if not paths:
+                item['encode_error'] = "Error splitting video into parts."
+                raise RuntimeError(f"splitting part {index} failed")
+            discard_file(path)
+            pieces = [(piece, (await probe(piece)).duration) for piece in paths]
+        for number, (piece, duration) in enumerate(pieces, start=1):
+            queued += 1
+            queue_part(item, piece, duration, queued, queued if last and number == len(pieces) else None)
+    return on_part
+
+async def prepare_logo(state, width, height):
+    """
+    For the 'imgwatermark' mode, set state['logo'] to the watermark image
+    pre-scaled for a width x height video. The scaled image is cached per
+    image and resolution, and the original is kept in the media cache, so a
+    bulk batch downloads and decodes the image once per resolution at most.
+    """
+    if state['mode'] != 'imgwatermark':
+        return state
+    image_msg = state['image_message']
+    media = get_image_media(image_msg)
+    name = media.file_unique_id + (os.path.splitext(getattr(media, 'file_name', None) or "")[1] or ".jpg")
+
+    async def fetch_image(path):
+        async with sessions.acquire() as session:
+            await session.client.download_media(image_msg, file_name=path)
+
+    logo = await get_logo_sprite(media.file_unique_id, width, height, lambda: media_cache.use(name, fetch_image))
+    return dict(state, logo=logo)
+
+def encode_thumbnail(state, item, duration, fps):
+    """
+    The thumbnail the encode should write alongside the video (see
+    build_encode_cmd), or None when the user sent a custom one.
+    """
     if 'custom_thumbnail' in state:
-        custom_thumb_path = os.path.join(temp_dir, f"{base_name}_custom_thumbnail.jpg")
-        await state['custom_thumbnail'].download(file_name=custom_thumb_path)
-        thumb = custom_thumb_path
-    else:
-        thumb = generate_thumbnail(output_file, thumb_path)
+        return None
+    item['thumb_path'] = os.path.join(item['temp_dir'], f"{item['base_name']}_thumbnail.jpg")
+    return item['thumb_path'], thumbnail_filter(duration, fps)
 
-    # Check file size and split if necessary
-    if os.path.getsize(output_file) > MAX_FILE_SIZE:
-        parts = split_video_by_size(output_file, temp_dir, MAX_FILE_SIZE)
-        if not parts:
-            await message.reply_text("Error splitting video into parts.")
-        else:
-            total_parts = len(parts)
-            for idx, part in enumerate(parts, start=1):
-                part_caption = original_caption = video_msg.caption if video_msg.caption else "Here is your watermarked video."
-                if 'custom_caption' in state:
-                    part_caption += "\n\n" + state['custom_caption']
-                part_caption += f"\n\nPart {idx} of {total_parts}"
-                try:
-                    await client.send_video(
-                        chat_id,
-                        video=part,
-                        thumb=thumb,
-                        caption=part_caption,
-                        progress=create_upload_progress(client, chat_id, progress_msg) if progress_msg else None,
-                        width=width,
-                        height=height,
-                        duration=duration_value,
-                        supports_streaming=True
-                    )
-                except Exception as e:
-                    logger.error(f"Error uploading part {idx} for chat {chat_id}: {e}")
-            if progress_msg:
-                try:
-                    await progress_msg.edit_text("Upload complete.")
-                except FloodWait:
-                    pass
-    else:
-        try:
-            await client.send_video(
-                chat_id,
-                video=output_file,
-                thumb=thumb,
-                caption=video_msg.caption if video_msg.caption else "Here is your watermarked video." + ("\n\n" + state['custom_caption'] if 'custom_caption' in state else ""),
-                progress=create_upload_progress(client, chat_id, progress_msg) if progress_msg else None,
-                width=width,
-                height=height,
-                duration=duration_value,
-                supports_streaming=True
+async def resolve_profile(item, state, width, height, duration, fps, parallel=1):
+    """
+    Turn preset 'auto' into a concrete preset/CRF for this item from
+    the measured throughput table, and announce the expected encode time.
+    """
+    if state.get('preset') != 'auto':
+        return state
+    profile = choose_profile(width, height, duration, fps, parallel)
+    logger.info(f"Auto profile: {profile}")
+    item['profile_note'] = f"\nAuto preset: {profile['preset']}, CRF {profile['crf']}, ETA ~{format_eta(profile['eta'])}"
+    await edit_progress(item, "Watermarking started." + item['profile_note'])
+    return dict(state, preset=profile['preset'], crf=profile['crf'])
+
+def apply_size_target(item, state, duration, audio_bit_rate):
+    """
+    With SIZE_TARGET, cap the video bitrate so the output of `duration`
+    seconds fits in one upload. Inputs that could only fit below
+    MIN_VIDEO_BITRATE keep plain CRF and are split as before.
+    """
+    if not SIZE_TARGET:
+        return state
+    maxrate = target_video_bitrate(duration, audio_bit_rate, PART_SIZE_LIMIT)
+    if not maxrate:
+        logger.info(f"A {duration:.0f}s video can't fit in one upload; it will be split.")
+        return state
+    logger.info(f"Capping the video bitrate at {maxrate} kbit/s so the output fits in one upload.")
+    item['size_target'] = maxrate
+    return dict(state, maxrate=maxrate)
+
+async def queue_output(item, output_file):
+    """
+    Queue a fully encoded output for upload, splitting it first if it is too large.
+    """
+    if os.path.getsize(output_file) <= MAX_FILE_SIZE:
+        queue_part(item, output_file, item['media_info'].duration, 1, 1)
+        return True
+    if item.get('size_target'):
+        logger.warning(f"Output overshot the size target at {item['size_target']} kbit/s; splitting it.")
+    parts = await split_video_by_size(output_file, item['temp_dir'], MAX_FILE_SIZE)
+    if not parts:
+        item['encode_error'] = "Error splitting video into parts."
+        return False
+    discard_file(output_file)
+    for index, part in enumerate(parts, start=1):
+        queue_part(item, part, (await probe(part)).duration, index, len(parts))
+    return True
+
+async def upload_stage(client, chat_id, state, item, default_caption):
+    """
+    Send the parts from item['parts'] as encode_stage closes them, so uploads
+    overlap the rest of the encode. The bytes of up to UPLOAD_CONCURRENCY
+    parts upload at once while the messages are sent strictly in part order;
+    a part whose upload or send fails is uploaded again, up to UPLOAD_ATTEMPTS
+    times. Parts sent before the total was known are re-captioned
+    "Part i of N" at the end. Returns an error text, naming any part that
+    could not be sent, or None.
+    """
+    video_msg = item['video_msg']
+    caption = build_caption(video_msg, state, default_caption)
+    thumb = None
+    unnumbered = []
+    total = 0
+    item['sent'] = []
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    progress = UploadProgress(lambda text: updater.edit(item.get('progress_msg'), text))
+    uploads = asyncio.Queue()
+    tasks = []
+
+    async def upload_part(part):
+        # The message is sent through the session that uploaded the bytes,
+        # inside the same acquire() so a FloodWait on the send pauses that
+        # session and the retry goes to another one. The upload slot is
+        # released before waiting for this part's turn to be sent.
+        async with sessions.acquire() as session:
+            async with semaphore:
+                with metrics.timed("upload"):
+                    uploaded = await pre_upload(session.client, part['path'], progress.callback(part['index']))
+            thumb, part_caption, width, height = await part['turn']
+            await updater.acquire()
+            return await send_uploaded_video(
+                session.client, chat_id, part['path'], uploaded, thumb,
+                part_caption, int(part['duration']), width, height
             )
-            if progress_msg:
-                try:
-                    await progress_msg.edit_text("Upload complete.")
-                except FloodWait:
-                    pass
+
+    def start_upload(part):
+        task = asyncio.ensure_future(upload_part(part))
+        tasks.append(task)
+        return task
+
+    async def collect():
+        while True:
+            part = await item['parts'].get()
+            if part is None:
+                break
+            progress.add(part['index'], os.path.getsize(part['path']))
+            part['turn'] = asyncio.get_event_loop().create_future()
+            await uploads.put((part, start_upload(part)))
+        await uploads.put(None)
+
+    collector = asyncio.ensure_future(collect())
+    try:
+        while True:
+            entry = await uploads.get()
+            if entry is None:
+                break
+            part, task = entry
+            total = part['index']
+            if thumb is None:
+                thumb = await get_thumbnail(state, item, part['path'])
+            if part['total'] == 1:
+                part_caption = caption
+            elif part['total']:
+                part_caption = caption + f"\n\nPart {part['index']} of {part['total']}"
+            else:
+                part_caption = caption + f"\n\nPart {part['index']}"
+            # The watermark pass keeps the frame size, so the input probe describes the output too.
+            width, height = item['media_info'].display_size()
+            size = os.path.getsize(part['path'])
+            part['turn'].set_result((thumb, part_caption, width, height))
+            sent = None
+            try:
+                for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+                    try:
+                        sent = await task
+                        break
+                    except Exception as e:
+                        logger.error(f"Error uploading part {part['index']} for chat {chat_id} (attempt {attempt}/{UPLOAD_ATTEMPTS}): {e}")
+                        if attempt < UPLOAD_ATTEMPTS:
+                            await asyncio.sleep(2 ** attempt)
+                            progress.reset(part['index'])
+                            task = start_upload(part)
+            finally:
+                discard_file(part['path'])
+            progress.finish(part['index'])
+            media = (sent.video or sent.document) if sent else None
+            item['sent'].append({
+                'file_id': media.file_id if media else None,
+                'caption': part_caption,
+                'size': size if media else 0,
+            })
+            if sent is None and part['total'] == 1:
+                return "Failed to send watermarked video."
+            if sent and not part['total']:
+                unnumbered.append((sent, part['index']))
+    finally:
+        collector.cancel()
+        for task in tasks:
+            task.cancel()
+    if 'encode_error' in item:
+        return item['encode_error']
+    for sent, index in unnumbered:
+        item['sent'][index - 1]['caption'] = caption + f"\n\nPart {index} of {total}"
+        try:
+            await updater.call(client.edit_message_caption, chat_id, sent.id, item['sent'][index - 1]['caption'])
         except Exception as e:
-            logger.error(f"Error sending video for chat {chat_id}: {e}")
-            await message.reply_text("Failed to send watermarked video.")
-    shutil.rmtree(temp_dir)
-    if chat_id in user_state:
-        del user_state[chat_id]
+            logger.error(f"Error numbering part {index} for chat {chat_id}: {e}")
+    missing = [str(index) for index, part in enumerate(item['sent'], 1) if not part['file_id']]
+    if missing:
+        return f"Failed to send part(s) {', '.join(missing)} of {total} of the watermarked video."
+    store_result(item)
+    await edit_progress(item, "Upload complete.")
+    return None
+
+async def get_thumbnail(state, item, video_file):
+    """
+    Use the custom thumbnail if provided, then the one the encode wrote;
+    generate one from video_file only if the encode couldn't (e.g. a resumed
+    chunked encode or a video without a usable frame in the window).
+    """
+    if 'custom_thumbnail' in state:
+        custom_thumb_path = os.path.join(item['temp_dir'], f"{item['base_name']}_custom_thumbnail.jpg")
+        await state['custom_thumbnail'].download(file_name=custom_thumb_path)
+        return custom_thumb_path
+    thumb_path = os.path.join(item['temp_dir'], f"{item['base_name']}_thumbnail.jpg")
+    if item.get('thumb_path') == thumb_path and os.path.exists(thumb_path) and os.path.getsize(thumb_path):
+        return thumb_path
+    return await generate_thumbnail(video_file, thumb_path)
+
+# ─── Processing Function for Single Watermark ───
+async def process_watermark(client, message, state, chat_id):
+    default_caption = "Here is your watermarked video."
+    key = result_key(state['video_message'], state, default_caption)
+    cached = result_cache.get(key)
+    if cached:
+        if await send_cached_result(client, chat_id, cached):
+            logger.info(f"Served chat {chat_id} from the result cache.")
+            return
+        result_cache.delete(key)
+    item = {'video_msg': state['video_message'], 'parts': asyncio.Queue(), 'result_key': key}
+    state['temp_dir'] = await open_work_dir(client, chat_id, item)
+    error = "interrupted"
+    try:
+        await download_stage(client, chat_id, item, allow_stream=True)
+        _, error = await run_stages(
+            encode_stage(client, chat_id, state, item),
+            upload_stage(client, chat_id, state, item, default_caption)
+        )
+        if error:
+            await updater.call(message.reply_text, error)
+    finally:
+        await close_work_dir(item, keep=bool(error))
 
 # ─── Processing Function for Bulk Watermark ───
 async def process_bulk_watermark(client, message, state, chat_id):
+    """
+    Run the bulk batch as a three-stage pipeline (download → encode → upload)
+    connected by bounded queues, so video N+1 downloads and video N-1 uploads
+    while video N encodes. Each stage has a single worker, which keeps the
+    results in the original order.
+    """
+    default_caption = "Here is your bulk watermarked video."
     videos = state.get('videos', [])
-    for video_msg in videos:
-        temp_dir = tempfile.mkdtemp()
-        if video_msg.video:
-            file_name = video_msg.video.file_name or f"{video_msg.video.file_id}.mp4"
-        elif video_msg.document:
-            file_name = video_msg.document.file_name or f"{video_msg.document.file_id}.mp4"
-        else:
-            file_name = "input_video.mp4"
-        input_file_path = os.path.join(temp_dir, file_name)
-        try:
-            progress_msg = await client.send_message(chat_id, "Downloading: 0%")
-        except FloodWait:
-            progress_msg = None
-        download_cb = create_download_progress(client, chat_id, progress_msg) if progress_msg else None
-        logger.info("Starting video download for bulk video...")
-        await video_msg.download(file_name=input_file_path, progress=download_cb)
-        logger.info("Video download completed for bulk video.")
-        if progress_msg:
+    open_items = []
+    encode_queue = asyncio.Queue(maxsize=BULK_QUEUE_SIZE)
+    upload_queue = asyncio.Queue(maxsize=BULK_QUEUE_SIZE)
+
+    async def downloader():
+        originals = {}
+        for video_msg in videos:
+            key = result_key(video_msg, state, default_caption)
+            if key in originals:
+                # Same file and caption as an earlier video: the uploader
+                # re-sends that one's parts once it has been delivered.
+                await encode_queue.put({'video_msg': video_msg, 'duplicate_of': originals[key], 'result_key': key, 'error': None})
+                continue
+            cached = result_cache.get(key)
+            if cached:
+                originals[key] = {'video_msg': video_msg, 'cached': cached, 'result_key': key, 'error': None}
+                await encode_queue.put(originals[key])
+                continue
+            item = originals[key] = {'video_msg': video_msg, 'error': None, 'parts': asyncio.Queue(), 'result_key': key}
+            await open_work_dir(client, chat_id, item)
+            open_items.append(item)
             try:
-                await progress_msg.edit_text("Download complete. Watermarking started.")
-            except FloodWait:
-                progress_msg = None
-        duration_sec = await get_video_duration(input_file_path)
-        if duration_sec <= 0:
-            duration_sec = 1
-        base_name = os.path.splitext(os.path.basename(input_file_path))[0]
-        if state['mode'] == 'watermarktm':
-            font_path = "cour.ttf"
-        else:
-            font_path = "/usr/share/fonts/truetype/consola.ttf"
-        if state['mode'] == 'watermark':
-            filter_str = (
-                f"drawtext=text='{state['watermark_text']}':"
-                f"fontcolor={state['font_color']}:" 
-                f"fontsize={state['font_size']}:" 
-                f"x=(w-text_w)/2:" 
-                f"y=(h-text_h-10)+((10-(h-text_h-10))*(mod(t\\,30)/30))"
-            )
-        elif state['mode'] == 'watermarktm':
-            filter_str = (
-                f"drawtext=text='{state['watermark_text']}':"
-                f"fontfile={font_path}:" 
-                f"fontcolor={state['font_color']}:" 
-                f"fontsize={state['font_size']}:" 
-                f"font='Courier New':"
-                f"x='mod(t\\,30)*30':"
-                f"y='mod(t\\,30)*15'"
-            )
-        output_file = os.path.join(temp_dir, f"{base_name}_watermarked.mp4")
-        ffmpeg_cmd = [
-            FFMPEG_PATH,
-            "-fflags", "+genpts",
-            "-i", input_file_path,
-            "-vf", filter_str,
-            "-c:v", "libx264", "-crf", "23", "-preset", state.get('preset', 'medium'),
-            "-movflags", "+faststart",
-            "-pix_fmt", "yuv420p",
-            "-c:a", "copy",
-            "-progress", "pipe:1",
-            output_file
-        ]
-        logger.info("Starting watermarking process for bulk video...")
-        proc = await asyncio.create_subprocess_exec(
-            *ffmpeg_cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT
-        )
-        last_logged = 0
+                await download_stage(client, chat_id, item, "Download complete. Waiting for encoder.")
+            except Exception as e:
+                logger.error(f"Error downloading bulk video for chat {chat_id}: {e}")
+                item['error'] = "Error downloading video."
+            await encode_queue.put(item)
+        await encode_queue.put(None)
+
+    async def encoder():
         while True:
-            line = await proc.stdout.readline()
-            if not line:
+            item = await encode_queue.get()
+            if item is None:
                 break
-            decoded_line = line.decode('utf-8').strip()
-            logger.info(decoded_line)
-            if decoded_line.startswith("out_time_ms="):
+            # The uploader takes the item before its encode starts and sends
+            # each part as soon as it is closed, after the previous video.
+            await upload_queue.put(item)
+            if not item['error'] and 'parts' in item:
+                await edit_progress(item, "Watermarking started.")
                 try:
-                    out_time_val = int(decoded_line.split("=")[1])
-                    current_sec = out_time_val / 1000000.0
-                    current_percent = (current_sec / duration_sec) * 100
-                    if current_percent > 100:
-                        current_percent = 100
-                    if current_percent - last_logged >= 5 or current_percent == 100:
-                        last_logged = current_percent
-                        if progress_msg:
-                            try:
-                                await progress_msg.edit_text(f"Watermark processing: {current_percent:.0f}% completed")
-                            except FloodWait:
-                                progress_msg = None
+                    await encode_stage(client, chat_id, state, item)
                 except Exception as e:
-                    logger.error("Error parsing ffmpeg progress for bulk: " + str(e))
-            if decoded_line == "progress=end":
-                break
-        await proc.wait()
-        if proc.returncode != 0:
-            logger.error(f"Error processing watermark for bulk video. Return code: {proc.returncode}")
-            await client.send_message(chat_id, "Error processing watermarked video.")
-            shutil.rmtree(temp_dir)
-            continue
+                    logger.error(f"Error encoding bulk video for chat {chat_id}: {e}")
+        await upload_queue.put(None)
 
-        # Retrieve metadata and generate thumbnail for the processed bulk video
-        metadata = get_video_details(output_file)
-        width = metadata.get("width", 0)
-        height = metadata.get("height", 0)
-        duration_value = int(metadata.get("duration", 0))
-        thumb_path = os.path.join(temp_dir, f"{base_name}_thumbnail.jpg")
-        # Use the custom thumbnail if provided; otherwise, generate one.
-        if 'custom_thumbnail' in state:
-            custom_thumb_path = os.path.join(temp_dir, f"{base_name}_custom_thumbnail.jpg")
-            await state['custom_thumbnail'].download(file_name=custom_thumb_path)
-            thumb = custom_thumb_path
-        else:
-            thumb = generate_thumbnail(output_file, thumb_path)
-
-        # Check file size and split if necessary
-        if os.path.getsize(output_file) > MAX_FILE_SIZE:
-            parts = split_video_by_size(output_file, temp_dir, MAX_FILE_SIZE)
-            if not parts:
-                await client.send_message(chat_id, "Error splitting bulk video into parts.")
-            else:
-                total_parts = len(parts)
-                for idx, part in enumerate(parts, start=1):
-                    part_caption = video_msg.caption if video_msg.caption else "Here is your bulk watermarked video."
-                    if 'custom_caption' in state:
-                        part_caption += "\n\n" + state['custom_caption']
-                    part_caption += f"\n\nPart {idx} of {total_parts}"
-                    try:
-                        await client.send_video(
-                            chat_id,
-                            video=part,
-                            thumb=thumb,
-                            caption=part_caption,
-                            progress=create_upload_progress(client, chat_id, progress_msg) if progress_msg else None,
-                            width=width,
-                            height=height,
-                            duration=duration_value,
-                            supports_streaming=True
-                        )
-                    except Exception as e:
-                        logger.error(f"Error uploading bulk part {idx} for chat {chat_id}: {e}")
-                if progress_msg:
-                    try:
-                        await progress_msg.edit_text("Upload complete.")
-                    except FloodWait:
-                        pass
-        else:
+    async def uploader():
+        while True:
+            item = await upload_queue.get()
+            if item is None:
+                break
+            error = "interrupted"
             try:
-                await client.send_video(
-                    chat_id,
-                    video=output_file,
-                    thumb=thumb,
-                    caption=video_msg.caption if video_msg.caption else "Here is your bulk watermarked video." + ("\n\n" + state['custom_caption'] if 'custom_caption' in state else ""),
-                    progress=create_upload_progress(client, chat_id, progress_msg) if progress_msg else None,
-                    width=width,
-                    height=height,
-                    duration=duration_value,
-                    supports_streaming=True
-                )
-                if progress_msg:
-                    try:
-                        await progress_msg.edit_text("Upload complete.")
-                    except FloodWait:
-                        pass
+                error = item['error']
+                if 'duplicate_of' in item:
+                    original = item['duplicate_of']
+                    parts = original.get('cached') or original.get('sent')
+                    if not original.get('delivered') or not all(part['file_id'] for part in parts):
+                        error = "Failed to send watermarked video."
+                    elif not await send_cached_result(client, chat_id, parts):
+                        error = "Failed to send watermarked video; please submit it again."
+                elif 'cached' in item:
+                    if not await send_cached_result(client, chat_id, item['cached']):
+                        result_cache.delete(item['result_key'])
+                        error = "Failed to send cached watermarked video; please submit it again."
+                elif not error:
+                    error = await upload_stage(client, chat_id, state, item, default_caption)
+                item['delivered'] = not error
+                # Delivered or reported either way, so a resumed batch skips it.
+                job_store.mark_item(state['job_id'], item['video_msg'].id, 'failed' if error else 'done')
+                if error:
+                    await updater.call(client.send_message, chat_id, error)
             except Exception as e:
-                logger.error(f"Error sending bulk video for chat {chat_id}: {e}")
-                await client.send_message(chat_id, "Failed to send watermarked video.")
-        shutil.rmtree(temp_dir)
-    if chat_id in bulk_state:
-        del bulk_state[chat_id]
+                logger.error(f"Error uploading bulk video for chat {chat_id}: {e}")
+                job_store.mark_item(state['job_id'], item['video_msg'].id, 'failed')
+            finally:
+                if item in open_items:
+                    open_items.remove(item)
+                    await close_work_dir(item, keep=bool(error))
+
+    try:
+        await run_stages(downloader(), encoder(), uploader())
+    finally:
+        # Items still sitting in the queues when the job is cancelled.
+        for item in open_items:
+            await close_work_dir(item, keep=True)
 
 # ─── Processing Functions for Overlay and Image Watermark ───
 async def process_overlay(client, message, state, chat_id):
-    temp_dir = tempfile.mkdtemp()
-    state['temp_dir'] = temp_dir
-    progress_msg = await client.send_message(chat_id, "Downloading main video: 0%")
-    main_msg = state['main_video_message']
-    if main_msg.video:
-        main_file_name = main_msg.video.file_name or f"{main_msg.video.file_id}.mp4"
-    elif main_msg.document:
-        main_file_name = main_msg.document.file_name or f"{main_msg.document.file_id}.mp4"
-    else:
-        main_file_name = "main_video.mp4"
-    main_file_path = os.path.join(temp_dir, main_file_name)
-    download_cb = create_download_progress(client, chat_id, progress_msg)
-    logger.info("Downloading main video...")
-    await main_msg.download(file_name=main_file_path, progress=download_cb)
-    logger.info("Main video downloaded.")
-    await progress_msg.edit_text("Main video downloaded.")
-    await progress_msg.edit_text("Downloading overlay video: 0%")
+    """
+    Composite the green-screen overlay video onto the main video. The overlay
+    is keyed and overlaid inside the encode's own filter graph (see
+    build_watermark_filter), so the main video goes through the same
+    download → encode → upload pipeline as a watermark, both inputs are
+    decoded once and the output is encoded once. Overlay clips are kept in
+    the media cache, so reusing one on further main videos skips its download.
+    """
+    default_caption = "Here is your overlay video."
+    key = result_key(state['main_video_message'], state, default_caption)
+    cached = result_cache.get(key)
+    if cached:
+        if await send_cached_result(client, chat_id, cached):
+            logger.info(f"Served chat {chat_id} from the result cache.")
+            return
+        result_cache.delete(key)
     overlay_msg = state['overlay_video_message']
-    if overlay_msg.video:
-        overlay_file_name = overlay_msg.video.file_name or f"{overlay_msg.video.file_id}.mp4"
-    elif overlay_msg.document:
-        overlay_file_name = overlay_msg.document.file_name or f"{overlay_msg.document.file_id}.mp4"
-    else:
-        overlay_file_name = "overlay_video.mp4"
-    overlay_file_path = os.path.join(temp_dir, overlay_file_name)
-    download_cb = create_download_progress(client, chat_id, progress_msg)
-    logger.info("Downloading overlay video...")
-    await overlay_msg.download(file_name=overlay_file_path, progress=download_cb)
-    logger.info("Overlay video downloaded.")
-    await progress_msg.edit_text("Overlay video downloaded.")
-    await progress_msg.edit_text("Pre-processing overlay video...")
-    processed_overlay_path = os.path.join(temp_dir, "processed_overlay.mov")
-    pre_process_cmd = [
-        FFMPEG_PATH,
-        "-i", overlay_file_path,
-        "-vf", "colorkey=0x00FF00:0.3:0.2,format=yuva420p",
-        "-c:v", "qtrle",
-        processed_overlay_path
-    ]
-    proc_pre = await asyncio.create_subprocess_exec(
-        *pre_process_cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.STDOUT
-    )
-    while True:
-        line = await proc_pre.stdout.readline()
-        if not line:
-            break
-        logger.info(line.decode('utf-8').strip())
-    await proc_pre.wait()
-    if proc_pre.returncode != 0:
-        await client.send_message(chat_id, "Error in pre-processing overlay video.")
-        shutil.rmtree(temp_dir)
-        return
-    # (Overlay processing logic continues here …)
-    shutil.rmtree(temp_dir)
+    overlay_name = get_media(overlay_msg).file_unique_id + os.path.splitext(get_input_file_name(overlay_msg))[1]
+
+    async def fetch_overlay(path):
+        logger.info("Downloading overlay video...")
+        with metrics.timed("download"):
+            await download_ranged(
+                sessions, overlay_msg, path, DOWNLOAD_PARALLEL, DOWNLOAD_CHECKPOINT_MIB,
+                create_download_progress(client, chat_id, None), DOWNLOAD_ATTEMPTS
+            )
+
+    item = {'video_msg': state['main_video_message'], 'parts': asyncio.Queue(), 'result_key': key}
+    state['temp_dir'] = await open_work_dir(client, chat_id, item)
+    error = "interrupted"
+    try:
+        async with media_cache.use(overlay_name, fetch_overlay) as overlay_path:
+            job_state = dict(state, overlay=overlay_path)
+            await download_stage(client, chat_id, item, "Download complete. Overlay processing started.", allow_stream=True)
+            _, error = await run_stages(
+                encode_stage(client, chat_id, job_state, item),
+                upload_stage(client, chat_id, job_state, item, default_caption)
+            )
+        if error:
+            await updater.call(message.reply_text, error)
+    finally:
+        await close_work_dir(item, keep=bool(error))
 
 async def process_imgwatermark(client, message, state, chat_id):
-    await client.send_message(chat_id, "Image watermark processing is not modified in bulk mode.")
+    """
+    Watermark the video with the image through the watermark pipeline; the
+    image is overlaid pre-scaled (see prepare_logo). Bulk batches with an
+    image run through process_bulk_watermark with the same mode.
+    """
+    default_caption = "Here is your image watermarked video."
+    video_msg = state['video_message']
+    key = result_key(video_msg, state, default_caption)
+    cached = result_cache.get(key)
+    if cached:
+        if await send_cached_result(client, chat_id, cached):
+            logger.info(f"Served chat {chat_id} from the result cache.")
+            return
+        result_cache.delete(key)
+    item = {'video_msg': video_msg, 'parts': asyncio.Queue(), 'result_key': key}
+    state['temp_dir'] = await open_work_dir(client, chat_id, item)
+    error = "interrupted"
+    try:
+        # A streaming encode needs the video size up front to scale the image.
+        await download_stage(client, chat_id, item, allow_stream=bool(video_msg.video and video_msg.video.width))
+        _, error = await run_stages(
+            encode_stage(client, chat_id, state, item),
+            upload_stage(client, chat_id, state, item, default_caption)
+        )
+        if error:
+            await updater.call(message.reply_text, error)
+    finally:
+        await close_work_dir(item, keep=bool(error))
+
+# Stored jobs name their process; these are the ones resume_jobs can run again.
+RESUMABLE_PROCESSES = {
+    process.__name__: process
+    for process in (process_watermark, process_bulk_watermark, process_overlay, process_imgwatermark)
+}
 
 # ─── Start the Pyrogram Client ───
 if __name__ == '__main__':
-    # Optional: Test thumbnail and metadata functions before starting the bot.
-    test_video = "path/to/your/test_video.mp4"
-    thumbnail = "path/to/output_thumbnail.jpg"
-    thumb = generate_thumbnail(test_video, thumbnail)
-    if thumb:
-        logging.info(f"Thumbnail generated at: {thumb}")
-    metadata = get_video_details(test_video)
-    if metadata:
-        logging.info(f"Video metadata: {metadata}")
-    app.run()
+    # The media paths are exercised offline by benchmark.py.
+    async def main():
+        await app.start()
+        await sessions.start()
+        scheduler.start()
+        updater.start()
+        storage.start(keep=[CHECKPOINT_DIR, MEDIA_CACHE_DIR])
+        media_cache.start()
+        await sweep_checkpoints()
+        await resume_jobs(app)
+        metrics.gauge("jobs_active", lambda: len(scheduler.running()))
+        metrics.gauge("jobs_queued", lambda: len(scheduler.pending()))
+        metrics.gauge("temp_reserved_bytes", storage.reserved)
+        metrics.gauge("sessions", sessions.status)
+        asyncio.ensure_future(metrics.writer(METRICS_PATH, METRICS_INTERVAL, [volume.path for volume in storage.volumes()]))
+        await idle()
+        await sessions.stop()
+        await app.stop()
+
+    app.run(main())
@@ -0,0 +1,73 @@
+import shutil
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from config import FFMPEG_PATH, MEDIA_CONCURRENCY, MEDIA_TIMEOUT, MEDIA_THREADS
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_semaphore = None
+_pool = ThreadPoolExecutor(max_workers=MEDIA_THREADS, thread_name_prefix="media")
+
+# ─── Async Subprocess and Thread Pool Helpers ───
+async def run_process(cmd, timeout=None):
+    """
+    Run an ffmpeg/ffprobe command without blocking the event loop.
+    At most MEDIA_CONCURRENCY of these run at once. The process is killed on
+    timeout (raising asyncio.TimeoutError) or when the caller is cancelled.
+    Returns (returncode, stdout, stderr).
+    """
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MEDIA_CONCURRENCY)
+    async with _semaphore:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            proc.kill()
+            await proc.wait()
+            raise
+    return proc.returncode, stdout, stderr
+
+async def run_blocking(func, *args):
+    """
+    Run a blocking call (file system work, pure-Python decoding...) on the media thread pool.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_pool, func, *args)
+
+async def remove_tree(path):
+    await run_blocking(shutil.rmtree, path, True)
+
+# ─── Thumbnail Generation using FFmpeg ───
+async def generate_thumbnail(video_file, thumbnail_path, time_offset="00:00:01.000"):
+    """
+    Generate a thumbnail image from a video file using FFmpeg.
+    """
+    # -ss before -i for faster seeking
+    command = [
+        FFMPEG_PATH,
+        "-ss", time_offset,
+        "-i", video_file,
+        "-frames:v", "1",
+        "-y",  # Overwrite if exists
+        thumbnail_path
+    ]
+    try:
+        with metrics.timed("thumbnail"):
+            returncode, _, stderr = await run_process(command, timeout=MEDIA_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"Thumbnail generation timed out after {MEDIA_TIMEOUT}s.")
+        return None
+    if returncode != 0:
+        logger.error(f"Thumbnail generation failed: {stderr.decode('utf-8', errors='replace')}")
+        return None
+    logger.info("Thumbnail generated successfully.")
+    return thumbnail_path
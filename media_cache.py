@@ -0,0 +1,71 @@
+import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class MediaCache:
+    """
+    Directory of media files reused across jobs (overlay clips, logos), keyed
+    by their Telegram file_unique_id plus any processing parameters. Files
+    are evicted least recently used first once the directory exceeds
+    max_bytes; a file that a job is using is never evicted.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._locks = {}
+        self._in_use = {}
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+        for entry in os.scandir(self.path):
+            if ".partial" in entry.name:
+                os.remove(entry.path)  # interrupted fill from a previous run
+
+    @asynccontextmanager
+    async def use(self, name, fill):
+        """
+        Yield the path of cached file `name`, awaiting fill(path) to create it
+        on a miss. The file stays in the cache (and on disk) until the block exits.
+        """
+        path = os.path.join(self.path, name)
+        self._in_use[path] = self._in_use.get(path, 0) + 1
+        try:
+            async with self._locks.setdefault(path, asyncio.Lock()):
+                if os.path.exists(path):
+                    os.utime(path)  # eviction goes by last use
+                    logger.info(f"Media cache hit: {name}")
+                else:
+                    partial = path + ".partial"
+                    try:
+                        await fill(partial)
+                        os.replace(partial, path)
+                    finally:
+                        if os.path.exists(partial):
+                            os.remove(partial)
+                    self.evict()
+            yield path
+        finally:
+            self._in_use[path] -= 1
+            if not self._in_use[path]:
+                del self._in_use[path]
+                self._locks.pop(path, None)
+
+    def evict(self):
+        entries = [
+            entry for entry in os.scandir(self.path)
+            if entry.is_file() and ".partial" not in entry.name
+        ]
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            if total <= self.max_bytes:
+                break
+            if entry.path in self._in_use:
+                continue
+            logger.info(f"Evicting {entry.name} from the media cache.")
+            total -= entry.stat().st_size
+            os.remove(entry.path)
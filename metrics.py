@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import logging
+from contextlib import contextmanager
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Stage latency histogram buckets in seconds (Prometheus "le" bounds).
+STAGE_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600]
+STAGES = ["download", "probe", "encode", "thumbnail", "split", "upload"]
+
+# Prefix of the per-job temp dirs, so their disk usage can be measured.
+TEMP_PREFIX = "wmbot_"
+
+_counters = defaultdict(float)
+_histograms = {stage: {"buckets": [0] * len(STAGE_BUCKETS), "sum": 0.0, "count": 0} for stage in STAGES}
+_encodes = {}
+_gauges = {}
+
+# ─── Recording ───
+def inc(name, value=1):
+    _counters[name] += value
+
+def observe(stage, seconds):
+    hist = _histograms.setdefault(stage, {"buckets": [0] * len(STAGE_BUCKETS), "sum": 0.0, "count": 0})
+    for i, bound in enumerate(STAGE_BUCKETS):
+        if seconds <= bound:
+            hist["buckets"][i] += 1
+    hist["sum"] += seconds
+    hist["count"] += 1
+
+@contextmanager
+def timed(stage):
+    """
+    Record the duration of the enclosed block (awaits included) in the stage histogram.
+    """
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(stage, time.monotonic() - started)
+
+def track_encode(stats):
+    _encodes[id(stats)] = stats
+
+def untrack_encode(stats):
+    _encodes.pop(id(stats), None)
+
+def gauge(name, func):
+    """
+    Register func() as the source of a gauge that is read at every snapshot.
+    """
+    _gauges[name] = func
+
+# ─── Snapshot ───
+def temp_usage(roots):
+    used = 0
+    for root in roots:
+        for entry in os.scandir(root):
+            if entry.name.startswith(TEMP_PREFIX) and entry.is_dir():
+                for dirpath, _, filenames in os.walk(entry.path):
+                    for name in filenames:
+                        try:
+                            used += os.path.getsize(os.path.join(dirpath, name))
+                        except OSError:
+                            pass  # removed while walking
+    return {"temp_bytes": used, "temp_free_bytes": shutil.disk_usage(roots[0]).free}
+
+def snapshot(rates, disk):
+    return {
+        "updated": time.time(),
+        "gauges": {name: func() for name, func in _gauges.items()},
+        "encodes": [
+            {
+                "label": stats.label,
+                "fps": round(stats.current_fps, 2),
+                "speed": round(stats.current_speed, 3),
+                "out_time": round(stats.out_time, 2),
+            }
+            for stats in _encodes.values()
+        ],
+        "counters": dict(_counters),
+        "rates": rates,
+        "disk": disk,
+        "stages": _histograms,
+        "stage_buckets": STAGE_BUCKETS,
+    }
+
+async def writer(path, interval, temp_roots):
+    """
+    Every `interval` seconds, write a JSON snapshot to `path` (atomically) for
+    the web process to serve. Transfer rates are derived from the byte counters,
+    temp usage from the job dirs in temp_roots (free space is the first root's).
+    """
+    loop = asyncio.get_event_loop()
+    last = {key: _counters[key] for key in ("download_bytes_total", "upload_bytes_total")}
+    last_time = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        rates = {}
+        for key in last:
+            rates[key.replace("_total", "_per_second")] = round((_counters[key] - last[key]) / (now - last_time), 1)
+            last[key] = _counters[key]
+        last_time = now
+        try:
+            disk = await loop.run_in_executor(None, temp_usage, temp_roots)
+            data = json.dumps(snapshot(rates, disk))
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Error writing metrics: {e}")
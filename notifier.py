@@ -0,0 +1,109 @@
+import time
+import asyncio
+import logging
+
+from pyrogram.errors import FloodWait, MessageNotModified
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MessageUpdater:
+    """
+    Shared, rate-limited gateway for the bot's own Telegram API calls.
+
+    - edit() coalesces edits per message: only the latest pending text is
+      sent, at most once every min_interval seconds per message.
+    - call() runs any other API call inside the same global budget of
+      calls_per_second, shared by all concurrent jobs.
+    - FloodWait pauses the whole budget for the requested time and the call
+      (or the pending edit) is retried afterwards instead of being dropped.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, calls_per_second, min_interval):
+        self.interval = 1.0 / calls_per_second
+        self.min_interval = min_interval
+        self.flood_waits = 0
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._pending = {}     # (chat_id, message_id) -> (message, text)
+        self._last_edit = {}   # (chat_id, message_id) -> monotonic time of the last edit
+        self._wakeup = None
+
+    def start(self):
+        """
+        Spawn the edit worker. Must be called from inside the running event loop.
+        """
+        self._wakeup = asyncio.Event()
+        asyncio.ensure_future(self._worker())
+
+    async def acquire(self):
+        """
+        Wait for the next free slot in the global API budget.
+        """
+        now = time.monotonic()
+        slot = max(now, self._next_slot, self._paused_until)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def _flood(self, e):
+        self.flood_waits += 1
+        metrics.inc("flood_waits_total")
+        self._paused_until = max(self._paused_until, time.monotonic() + e.value)
+        logger.warning(f"FloodWait of {e.value}s; pausing Telegram API calls.")
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Await func(*args, **kwargs) within the budget, retrying after FloodWait.
+        """
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            await self.acquire()
+            try:
+                return await func(*args, **kwargs)
+            except FloodWait as e:
+                self._flood(e)
+                if attempt == self.MAX_ATTEMPTS:
+                    raise
+
+    def edit(self, message, text):
+        """
+        Schedule message.edit_text(text), replacing any edit still pending for that message.
+        """
+        if message is None:
+            return
+        self._pending[(message.chat.id, message.id)] = (message, text)
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _worker(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            now = time.monotonic()
+            due = [key for key in self._pending if now - self._last_edit.get(key, 0) >= self.min_interval]
+            if not due:
+                next_due = min(self._last_edit[key] + self.min_interval for key in self._pending)
+                await asyncio.sleep(max(next_due - now, 0.05))
+                continue
+            for key in due:
+                message, text = self._pending.pop(key)
+                await self.acquire()
+                self._last_edit[key] = time.monotonic()
+                try:
+                    await message.edit_text(text)
+                except MessageNotModified:
+                    pass
+                except FloodWait as e:
+                    self._flood(e)
+                    self._pending.setdefault(key, (message, text))  # keep it unless a newer text arrived
+                except Exception as e:
+                    logger.error(f"Error updating message {key}: {e}")
+            # Forget messages that have gone quiet so the table doesn't grow forever.
+            cutoff = time.monotonic() - 600
+            for key in [key for key, last in self._last_edit.items() if last < cutoff and key not in self._pending]:
+                del self._last_edit[key]
@@ -0,0 +1,156 @@
+import os
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from config import FFPROBE_PATH, PROBE_CACHE_SIZE, MEDIA_TIMEOUT
+from media import run_process
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class MediaInfo:
+    width: int = 0
+    height: int = 0
+    duration: float = 0.0
+    video_duration: float = 0.0  # of the video stream; the format duration if it has none
+    fps: float = 0.0
+    video_codec: str = ""
+    audio_codec: str = ""
+    bit_rate: int = 0            # container bitrate, bits/s
+    audio_bit_rate: int = 0      # bits/s, 0 if unknown or no audio
+    rotation: int = 0            # display rotation in degrees
+    size: int = 0                # file size in bytes
+    keyframes: tuple = ()        # keyframe timestamps in seconds, only filled by probe(..., keyframes=True)
+
+    def display_size(self):
+        """
+        Width and height as ffmpeg outputs them after autorotation.
+        """
+        if self.rotation % 180:
+            return self.height, self.width
+        return self.width, self.height
+
+    def details(self):
+        """
+        The {width, height, duration} dict send_video expects.
+        """
+        width, height = self.display_size()
+        return {"width": width, "height": height, "duration": self.duration}
+
+
+# ─── ffprobe Command and JSON Parsing ───
+def build_probe_cmd(path, keyframes=False):
+    cmd = [
+        FFPROBE_PATH,
+        "-v", "error",
+        "-show_format",
+        "-show_streams",
+        "-of", "json",
+    ]
+    if keyframes:
+        # Packet flags come from the demuxer, so this reads but never decodes the file.
+        cmd += ["-show_packets", "-show_entries", "packet=stream_index,pts_time,flags"]
+    cmd.append(path)
+    return cmd
+
+def _float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+def _rate(value):
+    try:
+        num, den = value.split("/")
+        return float(num) / float(den) if float(den) else 0.0
+    except (AttributeError, ValueError):
+        return 0.0
+
+def _rotation(stream):
+    for side_data in stream.get("side_data_list", []):
+        if "rotation" in side_data:
+            return int(_float(side_data["rotation"]))
+    return int(_float(stream.get("tags", {}).get("rotate")))
+
+def parse_probe_output(data, size=0):
+    """
+    Turn ffprobe's JSON output (already decoded) into a MediaInfo.
+    """
+    fmt = data.get("format", {})
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), {})
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), {})
+    # Some containers report a short or missing format duration; trust the longer one.
+    duration = max(_float(fmt.get("duration")), _float(video.get("duration")))
+    keyframes = ()
+    if "packets" in data and video:
+        video_index = video.get("index")
+        keyframes = tuple(
+            _float(p.get("pts_time"))
+            for p in data["packets"]
+            if p.get("stream_index") == video_index and "K" in p.get("flags", "")
+        )
+    return MediaInfo(
+        width=int(video.get("width", 0)),
+        height=int(video.get("height", 0)),
+        duration=duration,
+        video_duration=_float(video.get("duration")) or _float(fmt.get("duration")),
+        fps=_rate(video.get("avg_frame_rate")) or _rate(video.get("r_frame_rate")),
+        video_codec=video.get("codec_name", ""),
+        audio_codec=audio.get("codec_name", ""),
+        bit_rate=int(_float(fmt.get("bit_rate"))),
+        audio_bit_rate=int(_float(audio.get("bit_rate"))),
+        rotation=_rotation(video) if video else 0,
+        size=size or int(_float(fmt.get("size"))),
+        keyframes=keyframes,
+    )
+
+# ─── Cached Async Probe ───
+_cache = OrderedDict()
+
+async def probe(path, keyframes=False):
+    """
+    Probe a media file with a single ffprobe call. Results are memoised by
+    (path, size, mtime) so repeated probes of an unchanged file are free.
+    Returns an empty MediaInfo if ffprobe fails.
+    """
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        logger.error(f"Cannot probe {path}: {e}")
+        return MediaInfo()
+    key = (path, st.st_size, st.st_mtime_ns, keyframes)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+    # A keyframe scan reads the whole file, so only the plain probe gets a timeout.
+    try:
+        with metrics.timed("probe"):
+            returncode, stdout, stderr = await run_process(build_probe_cmd(path, keyframes), None if keyframes else MEDIA_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"ffprobe timed out for {path}.")
+        return MediaInfo()
+    if returncode != 0:
+        logger.error(f"ffprobe failed for {path}: {stderr.decode('utf-8', errors='replace')}")
+        return MediaInfo()
+    try:
+        info = parse_probe_output(json.loads(stdout), st.st_size)
+    except ValueError as e:
+        logger.error(f"Unreadable ffprobe output for {path}: {e}")
+        return MediaInfo()
+    _cache[key] = info
+    if len(_cache) > PROBE_CACHE_SIZE:
+        _cache.popitem(last=False)
+    return info
+
+async def get_video_details(video_file):
+    """
+    Retrieve video details (width, height, duration).
+    """
+    info = await probe(video_file)
+    return info.details() if info.duration else {}
@@ -0,0 +1,87 @@
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def make_result_key(**inputs):
+    """
+    Stable cache key for everything that determines an output: source
+    file_unique_id, watermark mode and filter parameters, preset, thumbnail
+    and caption inputs.
+    """
+    blob = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Persistent map from a result key to the Telegram file_ids (and captions)
+    of the uploaded output parts, so a repeat request is answered by
+    re-sending them. Entries expire after max_age seconds, and only the
+    most recently used ones are kept, up to max_entries of them and a total
+    output size of max_bytes.
+    """
+
+    def __init__(self, path, max_entries, max_age, max_bytes):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY,"
+            " parts TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self.db.commit()
+
+    def get(self, key):
+        """
+        List of {'file_id', 'caption'} dicts in part order, or None.
+        """
+        row = self.db.execute("SELECT parts, created FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        parts, created = row
+        now = time.time()
+        if now - created > self.max_age:
+            self.delete(key)
+            return None
+        self.db.execute("UPDATE results SET last_used = ? WHERE key = ?", (now, key))
+        self.db.commit()
+        return json.loads(parts)
+
+    def put(self, key, parts, size):
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO results (key, parts, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+            (key, json.dumps(parts), size, now, now)
+        )
+        self.evict(now)
+        self.db.commit()
+        logger.info(f"Cached result {key[:12]} ({len(parts)} part(s), {size} bytes).")
+
+    def delete(self, key):
+        self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+        self.db.commit()
+
+    def evict(self, now=None):
+        now = now or time.time()
+        self.db.execute("DELETE FROM results WHERE created < ?", (now - self.max_age,))
+        self.db.execute(
+            "DELETE FROM results WHERE key NOT IN"
+            " (SELECT key FROM results ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,)
+        )
+        self.db.execute(
+            "DELETE FROM results WHERE key IN"
+            " (SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS total FROM results)"
+            " WHERE total > ?)",
+            (self.max_bytes,)
+        )
@@ -0,0 +1,112 @@
+import asyncio
+import itertools
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class JobScheduler:
+    """
+    Asyncio job queue with a fixed number of workers.
+
+    Every chat has its own FIFO queue; workers take the next job round-robin
+    across chats, so one chat's 40-video batch cannot starve everyone else.
+    """
+
+    def __init__(self, workers):
+        self.workers = max(1, workers)
+        self._queues = {}        # chat_id -> deque of pending jobs
+        self._order = deque()    # round-robin order of chats with pending jobs
+        self._running = []
+        self._available = None
+        self._ids = itertools.count(1)
+
+    def start(self):
+        """
+        Spawn the worker tasks. Must be called from inside the running event loop.
+        """
+        self._available = asyncio.Semaphore(0)
+        for _ in range(self.workers):
+            asyncio.ensure_future(self._worker())
+        logger.info(f"Job scheduler started with {self.workers} worker(s).")
+
+    def submit(self, chat_id, label, run):
+        """
+        Queue `run` (a coroutine function without arguments) for chat_id.
+        Returns the job's position in the dispatch order; positions up to
+        idle_workers() start right away.
+        """
+        job = {'id': next(self._ids), 'chat_id': chat_id, 'label': label, 'run': run, 'task': None}
+        if chat_id not in self._queues:
+            self._queues[chat_id] = deque()
+            self._order.append(chat_id)
+        self._queues[chat_id].append(job)
+        position = self.pending().index(job) + 1
+        self._available.release()
+        logger.info(f"Queued job {job['id']} ({label}) for chat {chat_id} at position {position}.")
+        return position
+
+    def idle_workers(self):
+        return self.workers - len(self._running)
+
+    def running(self):
+        return list(self._running)
+
+    def pending(self):
+        """
+        Pending jobs in the order the workers will take them.
+        """
+        queues = [self._queues[chat_id] for chat_id in self._order]
+        order = []
+        depth = 0
+        while True:
+            row = [queue[depth] for queue in queues if depth < len(queue)]
+            if not row:
+                return order
+            order.extend(row)
+            depth += 1
+
+    def cancel(self, chat_id):
+        """
+        Drop the pending jobs of chat_id and cancel its running ones.
+        Returns the number of jobs affected.
+        """
+        count = 0
+        queue = self._queues.pop(chat_id, None)
+        if queue:
+            self._order.remove(chat_id)
+            count += len(queue)
+        for job in self._running:
+            if job['chat_id'] == chat_id and job['task'] and not job['task'].done():
+                job['task'].cancel()
+                count += 1
+        return count
+
+    def _next_job(self):
+        chat_id = self._order.popleft()
+        queue = self._queues[chat_id]
+        job = queue.popleft()
+        if queue:
+            self._order.append(chat_id)
+        else:
+            del self._queues[chat_id]
+        return job
+
+    async def _worker(self):
+        while True:
+            await self._available.acquire()
+            if not self._order:
+                continue  # the job was cancelled while it was pending
+            job = self._next_job()
+            job['task'] = asyncio.ensure_future(job['run']())
+            self._running.append(job)
+            logger.info(f"Starting job {job['id']} ({job['label']}) for chat {job['chat_id']}.")
+            try:
+                await job['task']
+            except asyncio.CancelledError:
+                logger.info(f"Job {job['id']} for chat {job['chat_id']} was cancelled.")
+            except Exception as e:
+                logger.error(f"Job {job['id']} for chat {job['chat_id']} failed: {e}")
+            finally:
+                self._running.remove(job)
@@ -0,0 +1,123 @@
+import time
+import logging
+from contextlib import asynccontextmanager
+
+from pyrogram import Client
+from pyrogram.errors import FloodWait
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.active = 0
+        self.transfers = 0
+        self.errors = 0            # consecutive failed transfers
+        self.flood_waits = 0
+        self.paused_until = 0.0    # FloodWait or error cooldown
+        self.healthy = True        # False from ERROR_LIMIT failures until the next success
+
+    def available(self, now):
+        return self.paused_until <= now
+
+    def status(self):
+        return {
+            "session": self.name,
+            "healthy": self.healthy,
+            "active": self.active,
+            "transfers": self.transfers,
+            "errors": self.errors,
+            "flood_waits": self.flood_waits,
+            "paused_for": round(max(self.paused_until - time.monotonic(), 0), 1),
+        }
+
+
+class SessionPool:
+    """
+    Several MTProto sessions of the same bot for file transfers.
+
+    Every session is a separate login with its own connections and
+    per-session throughput limits; since they all belong to the same bot,
+    file_ids and messages work on any of them. acquire() hands out the
+    healthy, non-paused session with the fewest active transfers. A FloodWait
+    pauses only the session that got it; ERROR_LIMIT consecutive failures
+    take a session out for ERROR_COOLDOWN seconds, after which it gets
+    another chance.
+    """
+
+    ERROR_LIMIT = 3
+    ERROR_COOLDOWN = 60
+
+    def __init__(self, primary, size, api_id, api_hash, bot_token, max_transmissions=1):
+        self.sessions = [Session("primary", primary)]
+        self._extra = [
+            Session(
+                f"pool{index}",
+                Client(
+                    f"{primary.name}_pool{index}", api_id=api_id, api_hash=api_hash, bot_token=bot_token,
+                    no_updates=True, max_concurrent_transmissions=max_transmissions
+                )
+            )
+            for index in range(1, size)
+        ]
+
+    async def start(self):
+        """
+        Log in the extra sessions; one that fails to start is left out of the pool.
+        """
+        for session in self._extra:
+            try:
+                await session.client.start()
+            except Exception as e:
+                logger.error(f"Transfer session {session.name} failed to start: {e}")
+                continue
+            self.sessions.append(session)
+        logger.info(f"Transfer session pool: {len(self.sessions)} session(s).")
+
+    async def stop(self):
+        for session in self.sessions[1:]:
+            try:
+                await session.client.stop()
+            except Exception as e:
+                logger.error(f"Error stopping transfer session {session.name}: {e}")
+
+    def pick(self):
+        now = time.monotonic()
+        candidates = [session for session in self.sessions if session.available(now)]
+        if not candidates:
+            # Everything is paused: take the one that resumes first rather than failing.
+            candidates = [min(self.sessions, key=lambda session: session.paused_until)]
+        return min(candidates, key=lambda session: session.active)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """
+        Yield a Session for one transfer and record how it went.
+        """
+        session = self.pick()
+        session.active += 1
+        session.transfers += 1
+        try:
+            yield session
+        except FloodWait as e:
+            session.flood_waits += 1
+            session.paused_until = time.monotonic() + e.value
+            logger.warning(f"FloodWait of {e.value}s on transfer session {session.name}.")
+            raise
+        except Exception:
+            session.errors += 1
+            if session.errors >= self.ERROR_LIMIT:
+                session.healthy = False
+                session.paused_until = time.monotonic() + self.ERROR_COOLDOWN
+                logger.warning(f"Transfer session {session.name} failed {session.errors} times in a row; pausing it.")
+            raise
+        else:
+            session.errors = 0
+            session.healthy = True
+        finally:
+            session.active -= 1
+
+    def status(self):
+        return [session.status() for session in self.sessions]
@@ -0,0 +1,140 @@
+import os
+import bisect
+import asyncio
+import logging
+
+from config import FFMPEG_PATH, FFPROBE_PATH
+from media import run_process
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Estimated bytes of MP4 index (moov) per packet, and fixed container overhead per part.
+INDEX_BYTES_PER_PACKET = 20
+PART_OVERHEAD = 64 * 1024
+# Each retry after an oversized part plans against a limit this much smaller.
+REPLAN_FACTOR = 0.95
+MAX_PLANS = 3
+
+# ─── Packet Index ───
+async def scan_packets(path):
+    """
+    Read the packet index of `path` in a single demux pass (no decoding).
+    Returns (video_index, packets) with packets as (stream_index, time, size, keyframe)
+    tuples in file order, or (None, []) if ffprobe fails.
+    """
+    cmd = [
+        FFPROBE_PATH, "-v", "error",
+        "-show_entries", "stream=index,codec_type:packet=stream_index,pts_time,dts_time,size,flags",
+        "-of", "csv",
+        path
+    ]
+    returncode, stdout, stderr = await run_process(cmd)
+    if returncode != 0:
+        logger.error(f"Packet scan failed for {path}: {stderr.decode('utf-8', errors='replace')}")
+        return None, []
+    video_index = None
+    packets = []
+    for line in stdout.decode("utf-8", errors="replace").splitlines():
+        fields = line.split(",")
+        if fields[0] == "stream" and len(fields) >= 3 and fields[2] == "video" and video_index is None:
+            video_index = int(fields[1])
+        elif fields[0] == "packet" and len(fields) >= 6:
+            _, stream_index, pts_time, dts_time, size, flags = fields[:6]
+            time_str = pts_time if pts_time not in ("", "N/A") else dts_time
+            try:
+                packets.append((int(stream_index), float(time_str), int(size), "K" in flags))
+            except ValueError:
+                continue  # no timestamp at all; contributes nothing we can place
+    return video_index, packets
+
+# ─── Planning ───
+def plan_split(video_index, packets, size_limit):
+    """
+    Keyframe-aligned cut points that keep every part under size_limit with
+    the fewest parts: each part extends to the furthest keyframe at which its
+    packets (all streams, by timestamp) plus the estimated container overhead
+    still fit. Returns [(start, end), ...] with end None for the last part,
+    or None if a single GOP is already too large.
+    """
+    keyframes = sorted({t for stream, t, _, key in packets if stream == video_index and key})
+    if not keyframes:
+        return None
+    # Bytes and packet counts per GOP, where GOP i spans [keyframes[i], keyframes[i + 1]).
+    gop_bytes = [0] * len(keyframes)
+    gop_packets = [0] * len(keyframes)
+    for _, t, size, _ in packets:
+        gop = max(bisect.bisect_right(keyframes, t) - 1, 0)  # packets before the first keyframe go to GOP 0
+        gop_bytes[gop] += size
+        gop_packets[gop] += 1
+    plan = []
+    start = 0
+    while start < len(keyframes):
+        size = PART_OVERHEAD
+        end = start
+        while end < len(keyframes):
+            next_size = size + gop_bytes[end] + gop_packets[end] * INDEX_BYTES_PER_PACKET
+            if next_size > size_limit:
+                break
+            size = next_size
+            end += 1
+        if end == start:
+            logger.error(f"GOP at {keyframes[start]:.2f}s alone exceeds {size_limit} bytes; can't split there.")
+            return None
+        plan.append((keyframes[start], keyframes[end] if end < len(keyframes) else None))
+        start = end
+    return plan
+
+# ─── Extraction ───
+async def extract_part(input_file, output_file, start, end, frame_time):
+    """
+    Stream-copy [start, end) of input_file. The seek aims half a frame past
+    the keyframe so rounding can't snap it back to the previous one, and the
+    duration ends half a frame before the next part's keyframe.
+    """
+    seek = start + frame_time / 2 if start else 0
+    cmd = [FFMPEG_PATH]
+    if seek:
+        cmd += ["-ss", f"{seek:.6f}"]
+    cmd += ["-i", input_file]
+    if end is not None:
+        cmd += ["-t", f"{end - frame_time / 2 - seek:.6f}"]
+    cmd += ["-map", "0", "-c", "copy", "-avoid_negative_ts", "make_zero", "-movflags", "+faststart", "-y", output_file]
+    returncode, _, stderr = await run_process(cmd)
+    if returncode != 0:
+        logger.error(f"Extracting {start:.2f}-{end}s failed: {stderr.decode('utf-8', errors='replace')}")
+        return False
+    return True
+
+async def split_video_by_size(input_file, output_dir, segment_size):
+    """
+    Split a video file into keyframe-aligned parts not exceeding segment_size
+    bytes, planned from one scan of the packet index and extracted in parallel.
+    Part sizes are checked and the plan is redone with a lower limit if one
+    comes out too large. Returns the part paths in order, or [] on failure.
+    """
+    with metrics.timed("split"):
+        video_index, packets = await scan_packets(input_file)
+        video_times = sorted(t for stream, t, _, _ in packets if stream == video_index)
+        frame_time = (video_times[-1] - video_times[0]) / (len(video_times) - 1) if len(video_times) > 1 else 0.04
+        limit = segment_size
+        for _ in range(MAX_PLANS):
+            plan = plan_split(video_index, packets, limit)
+            if not plan:
+                return []
+            logger.info(f"Split plan: {len(plan)} part(s) under {limit} bytes.")
+            parts = [os.path.join(output_dir, f"part_{index:03d}.mp4") for index in range(len(plan))]
+            # run_process bounds how many of these run at once.
+            results = await asyncio.gather(*[
+                extract_part(input_file, path, start, end, frame_time) for path, (start, end) in zip(parts, plan)
+            ])
+            if not all(results):
+                return []
+            oversized = [path for path in parts if os.path.getsize(path) > segment_size]
+            if not oversized:
+                return parts
+            logger.warning(f"{len(oversized)} part(s) came out above {segment_size} bytes; re-planning.")
+            for path in parts:
+                os.remove(path)
+            limit = int(limit * REPLAN_FACTOR)
+        return []
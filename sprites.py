@@ -0,0 +1,105 @@
+import os
+import hashlib
+import logging
+
+from PIL import Image, ImageDraw, ImageFont
+
+from config import SPRITE_CACHE_DIR, DEFAULT_FONT_PATH, WATERMARK_RENDERER, IMG_WATERMARK_SCALE
+from media import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# Font used by each text watermark mode.
+MODE_FONTS = {
+    'watermark': DEFAULT_FONT_PATH,
+    'harrypotter': DEFAULT_FONT_PATH,
+    'watermarktm': "cour.ttf",
+}
+
+# ─── Text Sprites ───
+def sprite_path(text, font_path, size, color):
+    key = hashlib.sha1(f"{text}\0{os.path.abspath(font_path)}\0{size}\0{color}".encode("utf-8")).hexdigest()
+    return os.path.join(SPRITE_CACHE_DIR, f"text_{key}.png")
+
+def render_text_sprite(text, font_path, size, color, path):
+    """
+    Rasterise `text` once into a tightly cropped RGBA PNG at `path`.
+    """
+    font = ImageFont.truetype(font_path, size)
+    left, top, right, bottom = font.getbbox(text)
+    image = Image.new("RGBA", (max(right - left, 1), max(bottom - top, 1)), (0, 0, 0, 0))
+    ImageDraw.Draw(image).text((-left, -top), text, font=font, fill=color)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp.png"
+    image.save(tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+async def get_text_sprite(text, font_path, size, color):
+    """
+    Path of the cached sprite for (text, font, size, color), rendering it on first use.
+    """
+    path = sprite_path(text, font_path, size, color)
+    if not os.path.exists(path):
+        await run_blocking(render_text_sprite, text, font_path, size, color, path)
+        logger.info(f"Rendered watermark sprite {path}")
+    return path
+
+# ─── Image Watermarks ───
+def logo_path(unique_id, width, height):
+    return os.path.join(SPRITE_CACHE_DIR, f"logo_{unique_id}_{width}x{height}.png")
+
+def logo_size(image_size, width, height):
+    """
+    Size of the watermark image on a width x height video: IMG_WATERMARK_SCALE
+    of the video width, at most half the video height, aspect ratio kept.
+    """
+    image_width, image_height = image_size
+    scale = min(width * IMG_WATERMARK_SCALE / image_width, height / 2 / image_height)
+    return max(round(image_width * scale), 1), max(round(image_height * scale), 1)
+
+def render_logo(source, width, height, path):
+    """
+    Decode the watermark image once and save it pre-scaled for a
+    width x height video as an RGBA PNG at `path`.
+    """
+    with Image.open(source) as image:
+        image = image.convert("RGBA")
+    # Resampled premultiplied, so transparent pixels don't bleed dark fringes into the edges.
+    logo = image.convert("RGBa").resize(logo_size(image.size, width, height), Image.LANCZOS).convert("RGBA")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp.png"
+    logo.save(tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+async def get_logo_sprite(unique_id, width, height, open_source):
+    """
+    Path of the cached watermark image `unique_id` scaled for a width x height
+    video, rendering it on first use from the file path open_source() yields
+    (an async context manager, only entered on a miss).
+    """
+    path = logo_path(unique_id, width, height)
+    if not os.path.exists(path):
+        async with open_source() as source:
+            await run_blocking(render_logo, source, width, height, path)
+        logger.info(f"Rendered image watermark {path}")
+    return path
+
+async def prepare_watermark(state):
+    """
+    Return the job state with 'sprite' set, so build_watermark_filter uses the
+    overlay filter instead of per-frame drawtext. Falls back to drawtext
+    (the unchanged state) if sprites are disabled or rendering fails.
+    """
+    if WATERMARK_RENDERER != "sprite" or state.get('sprite'):
+        return state
+    font_path = MODE_FONTS.get(state['mode'])
+    if not font_path:
+        return state
+    try:
+        sprite = await get_text_sprite(state['watermark_text'], font_path, int(state['font_size']), state['font_color'])
+    except (OSError, ValueError) as e:
+        logger.error(f"Sprite rendering failed, using drawtext: {e}")
+        return state
+    return dict(state, sprite=sprite)
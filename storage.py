@@ -0,0 +1,111 @@
+import os
+import shutil
+import asyncio
+import logging
+import tempfile
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Volume:
+    """
+    A scratch directory with a byte budget shared by the jobs working in it.
+    """
+
+    def __init__(self, path, budget, reserve):
+        self.path = path
+        self.budget = budget       # 0 until start() sizes it from the free space
+        self.reserve = reserve     # bytes of free space never budgeted
+        self.reserved = 0
+
+    def start(self):
+        if not self.budget:
+            self.budget = max(shutil.disk_usage(self.path).free - self.reserve, 0)
+        logger.info(f"Scratch volume {self.path}: budget {self.budget} bytes.")
+
+
+class Reservation:
+    def __init__(self, volume, size):
+        self.volume = volume
+        self.size = size
+
+
+class StorageManager:
+    """
+    Budgets temp space across concurrent jobs.
+
+    A job reserves its projected footprint (input size x footprint_factor)
+    before it downloads anything and waits while the reservations on its
+    volume would exceed the budget; a job larger than the whole budget still
+    runs, alone. Jobs whose footprint is at most small_limit go to the small
+    scratch volume (e.g. a tmpfs) when one is configured.
+    """
+
+    def __init__(self, scratch_dir, budget, reserve, footprint_factor, small_dir=None, small_budget=0, small_limit=0):
+        self.footprint_factor = footprint_factor
+        self.large = Volume(scratch_dir, budget, reserve)
+        self.small = Volume(small_dir, small_budget, 0) if small_dir else None
+        self.small_limit = small_limit
+        self._changed = None
+
+    def volumes(self):
+        return [self.large, self.small] if self.small else [self.large]
+
+    def start(self, keep=()):
+        """
+        Sweep orphaned temp dirs and size the budgets. Must be called from
+        inside the running event loop, before any job runs.
+        """
+        self._changed = asyncio.Condition()
+        for volume in self.volumes():
+            os.makedirs(volume.path, exist_ok=True)
+            self.sweep_orphans(volume.path, keep)
+            volume.start()
+
+    def sweep_orphans(self, root, keep=()):
+        """
+        Remove the temp dirs a previous run left behind (nothing is running yet).
+        """
+        keep = {os.path.abspath(path) for path in keep}
+        for entry in os.scandir(root):
+            if entry.name.startswith(metrics.TEMP_PREFIX) and entry.is_dir() and os.path.abspath(entry.path) not in keep:
+                logger.info(f"Removing orphaned temp dir {entry.path}")
+                shutil.rmtree(entry.path, True)
+
+    def footprint(self, input_size):
+        return int(input_size * self.footprint_factor)
+
+    def reserved(self):
+        return sum(volume.reserved for volume in self.volumes())
+
+    async def reserve(self, input_size, on_wait=None, volume=None):
+        """
+        Wait until the projected footprint of a job with an input of
+        input_size bytes fits, and reserve it. on_wait() is awaited once if
+        the job has to wait. Pass volume to force the large or small volume.
+        """
+        size = self.footprint(input_size)
+        if volume is None:
+            volume = self.small if self.small and size <= self.small_limit else self.large
+        if on_wait and not self._fits(volume, size):
+            await on_wait()
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._fits(volume, size))
+            volume.reserved += size
+        return Reservation(volume, size)
+
+    def _fits(self, volume, size):
+        return volume.reserved == 0 or volume.reserved + size <= volume.budget
+
+    async def release(self, reservation):
+        if reservation is None:
+            return
+        async with self._changed:
+            reservation.volume.reserved -= reservation.size
+            self._changed.notify_all()
+
+    def make_temp_dir(self, reservation=None):
+        volume = reservation.volume if reservation else self.large
+        return tempfile.mkdtemp(prefix=metrics.TEMP_PREFIX, dir=volume.path)
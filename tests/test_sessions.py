@@ -0,0 +1,38 @@
+import time
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from pyrogram.errors import FloodWait
+
+from sessions import SessionPool
+from transfer import read_head
+
+
+class FloodingClient:
+    name = "bot"
+
+    async def stream_media(self, message, offset=0, limit=0):
+        raise FloodWait(value=30)
+        yield b""
+
+
+class FloodWaitTest(unittest.TestCase):
+    def test_flood_wait_pauses_the_session(self):
+        pool = SessionPool(FloodingClient(), 1, 0, "", "")
+
+        async def run():
+            async with pool.acquire() as session:
+                await read_head(session.client, SimpleNamespace())
+
+        with self.assertRaises(FloodWait):
+            asyncio.run(run())
+        session = pool.sessions[0]
+        self.assertEqual(session.flood_waits, 1)
+        self.assertGreater(session.paused_until, time.monotonic() + 25)
+        self.assertFalse(session.available(time.monotonic()))
+        self.assertEqual(session.active, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,243 @@
+import os
+import struct
+import asyncio
+import logging
+
+from pyrogram.errors import FloodWait
+
+from media import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# pyrogram's stream_media yields the file in chunks of this size.
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# ─── Message Media Helpers ───
+def get_media(message):
+    return message.video or message.document
+
+def get_media_size(message):
+    media = get_media(message)
+    return media.file_size if media and media.file_size else 0
+
+def get_media_duration(message):
+    """
+    Duration Telegram reports for the message (videos only), 0 if unknown.
+    """
+    return message.video.duration if message.video and message.video.duration else 0
+
+# ─── Streaming Ingest ───
+def is_streamable(head: bytes) -> bool:
+    """
+    Whether ffmpeg can decode a file from a pipe, judged by its first bytes.
+    MP4/MOV needs the moov atom before mdat; Matroska/WebM and MPEG-TS
+    can always be read sequentially. Anything else goes through a staged download.
+    """
+    if head[:4] == b"\x1a\x45\xdf\xa3":  # EBML header: Matroska / WebM
+        return True
+    if len(head) >= 377 and head[0] == head[188] == head[376] == 0x47:  # MPEG-TS sync bytes
+        return True
+    pos = 0
+    while pos + 8 <= len(head):
+        size, box_type = struct.unpack(">I4s", head[pos:pos + 8])
+        if box_type == b"moov":
+            return True
+        if box_type == b"mdat":
+            return False
+        if size == 1:
+            if pos + 16 > len(head):
+                return False
+            size = struct.unpack(">Q", head[pos + 8:pos + 16])[0]
+        if size < 8:
+            return False  # size 0 (box runs to EOF) or garbage
+        pos += size
+    return False  # moov not within the first chunk; can't tell
+
+async def read_head(client, message):
+    """
+    First chunk of the message's media, or b"" if it can't be fetched.
+    FloodWait is raised as-is so the session pool can pause the session.
+    """
+    try:
+        async for chunk in client.stream_media(message, limit=1):
+            return chunk
+    except FloodWait:
+        raise
+    except Exception as e:
+        logger.error(f"Error reading media head: {e}")
+    return b""
+
+async def iter_media(client, message, head, on_chunk=None):
+    """
+    Yield the whole media of `message`, starting with the already fetched
+    first chunk `head`. on_chunk(bytes_so_far) is awaited after every chunk.
+    Raises RuntimeError if the stream ends short of the media's file_size.
+    """
+    total = get_media_size(message)
+    done = len(head)
+    yield head
+    if on_chunk:
+        await on_chunk(done)
+    if len(head) >= STREAM_CHUNK_SIZE:  # otherwise the head already was the whole file
+        async for chunk in client.stream_media(message, offset=len(head) // STREAM_CHUNK_SIZE):
+            done += len(chunk)
+            yield chunk
+            if on_chunk:
+                await on_chunk(done)
+    # stream_media logs and swallows transfer errors and just stops early.
+    if total and done != total:
+        raise RuntimeError(f"media stream ended at {done} of {total} bytes")
+
+# ─── Ranged Downloads ───
+def preallocate(fd, size):
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)  # sparse, but still lets every range write at its offset
+
+def load_spans(sidecar, header):
+    """
+    Indexes of the chunks a sidecar records as complete, or None if there is
+    no sidecar or it belongs to another file.
+    """
+    try:
+        with open(sidecar) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return None
+    if not lines or lines[0] != header:
+        return None
+    done = set()
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) == 2 and all(field.isdigit() for field in fields):
+            done.update(range(int(fields[0]), int(fields[1])))
+    return done
+
+def mark_span(sidecar, start, end):
+    # Blocking (fsync); run it with run_blocking, off the event loop.
+    with open(sidecar, "a") as f:
+        f.write(f"{start} {end}\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def plan_runs(missing, parallel):
+    """
+    Group the missing chunk indexes into contiguous [start, end) runs, then
+    split the longest run until there are `parallel` of them.
+    """
+    runs = []
+    for index in sorted(missing):
+        if runs and runs[-1][1] == index:
+            runs[-1][1] += 1
+        else:
+            runs.append([index, index + 1])
+    while runs and len(runs) < parallel:
+        longest = max(runs, key=lambda run: run[1] - run[0])
+        if longest[1] - longest[0] < 2:
+            break
+        middle = (longest[0] + longest[1]) // 2
+        runs.insert(runs.index(longest) + 1, [middle, longest[1]])
+        longest[1] = middle
+    return [tuple(run) for run in runs]
+
+async def download_ranged(pool, message, path, parallel=4, checkpoint_chunks=32, on_progress=None, attempts=3):
+    """
+    Download the media of `message` to `path` as `parallel` contiguous byte
+    ranges fetched concurrently, each with a single stream_media call on a
+    session from `pool` (every call sets up its own media connection, which
+    is costly for files on another DC).
+
+    Chunks are written at their offset in a preallocated `path.part`, and
+    every checkpoint_chunks chunks the finished span is appended to the
+    `path.part.ranges` sidecar, so an interrupted download resumes with the
+    missing chunks only. A range whose stream stops early continues from
+    where it stopped; `attempts` failures in a row without progress give up.
+    A FloodWait is raised as-is once the pool has paused its session.
+    The file is moved to `path` once every chunk is in. on_progress(done,
+    total) is awaited as bytes arrive.
+    """
+    media = get_media(message)
+    total = get_media_size(message)
+    if not total:
+        raise ValueError("media has no known file_size")
+    partial = path + ".part"
+    sidecar = partial + ".ranges"
+    count = (total + STREAM_CHUNK_SIZE - 1) // STREAM_CHUNK_SIZE
+    header = f"{media.file_unique_id} {total}"
+
+    def chunk_length(index):
+        return min(STREAM_CHUNK_SIZE, total - index * STREAM_CHUNK_SIZE)
+
+    done = load_spans(sidecar, header) if os.path.exists(partial) else None
+    if done is None or os.path.getsize(partial) != total:
+        with open(partial, "wb") as f:
+            preallocate(f.fileno(), total)
+        with open(sidecar, "w") as f:
+            f.write(header + "\n")
+        done = set()
+    elif done:
+        logger.info(f"Resuming download of {path}: {len(done)}/{count} chunk(s) already complete.")
+
+    received = sum(chunk_length(index) for index in done)
+
+    async def report(size):
+        nonlocal received
+        received += size
+        if on_progress:
+            await on_progress(received, total)
+
+    async def fetch(fd, start, end):
+        failures = 0
+        while start < end:
+            position = start
+            marked = start
+            try:
+                async with pool.acquire() as session:
+                    # stream_media logs and swallows transfer errors and just stops early.
+                    async for chunk in session.client.stream_media(message, offset=start, limit=end - start):
+                        if len(chunk) != chunk_length(position):
+                            raise RuntimeError(f"chunk {position} came back with {len(chunk)} bytes")
+                        os.pwrite(fd, chunk, position * STREAM_CHUNK_SIZE)
+                        position += 1
+                        await report(len(chunk))
+                        if position - marked >= checkpoint_chunks:
+                            await run_blocking(mark_span, sidecar, marked, position)
+                            marked = position
+                    if position < end:
+                        raise RuntimeError(f"stream stopped at chunk {position} of {end}")
+            except (OSError, FloodWait):
+                raise
+            except Exception as e:
+                failures = 0 if position > start else failures + 1
+                logger.error(f"Range {start}-{end} of {path} failed ({failures}/{attempts} without progress): {e}")
+                if failures >= attempts:
+                    raise RuntimeError(f"download of {os.path.basename(path)} failed at chunk {position}") from e
+                await asyncio.sleep(2 ** max(failures, 1))
+            finally:
+                if position > marked:
+                    await run_blocking(mark_span, sidecar, marked, position)
+            start = position
+
+    runs = iter(plan_runs(set(range(count)) - done, parallel))
+
+    async def worker(fd):
+        for start, end in runs:
+            await fetch(fd, start, end)
+
+    if len(done) < count:
+        await report(0)
+        fd = os.open(partial, os.O_WRONLY)
+        tasks = [asyncio.ensure_future(worker(fd)) for _ in range(parallel)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            os.close(fd)
+
+    if load_spans(sidecar, header) != set(range(count)) or os.path.getsize(partial) != total:
+        raise RuntimeError(f"download of {os.path.basename(path)} is incomplete")
+    os.replace(partial, path)
+    os.remove(sidecar)
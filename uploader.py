@@ -0,0 +1,97 @@
+import os
+import logging
+
+from pyrogram import raw, types, utils
+from pyrogram.errors import FilePartMissing
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class UploadProgress:
+    """
+    Aggregated progress of the parts of one output uploading concurrently.
+    on_update(text) is called with the combined percentage on every callback;
+    the message updater coalesces the edits.
+    """
+
+    def __init__(self, on_update):
+        self.on_update = on_update
+        self.done = {}
+        self.sizes = {}
+        self.finished = 0
+
+    def add(self, index, size):
+        self.sizes[index] = size
+        self.done[index] = 0
+
+    def callback(self, index):
+        async def progress(current, total):
+            metrics.inc("upload_bytes_total", max(current - self.done[index], 0))
+            self.done[index] = current
+            self._report()
+        return progress
+
+    def reset(self, index):
+        # A retried part starts from zero again.
+        self.done[index] = 0
+
+    def finish(self, index):
+        self.finished += 1
+        self._report()
+
+    def _report(self):
+        total = sum(self.sizes.values())
+        if total:
+            percent = sum(self.done.values()) / total * 100
+            self.on_update(f"Uploading: {percent:.0f}% ({self.finished}/{len(self.sizes)} part(s) sent)")
+
+
+async def pre_upload(client, path, progress=None):
+    """
+    Upload the bytes of `path` without sending a message. Returns the raw
+    InputFile(Big); the caller retries a failed upload.
+    """
+    # save_file logs and swallows transfer errors, returning None.
+    uploaded = await client.save_file(path, progress=progress)
+    if uploaded is None:
+        raise RuntimeError(f"upload of {os.path.basename(path)} failed")
+    return uploaded
+
+
+async def send_uploaded_video(client, chat_id, path, uploaded, thumb, caption, duration, width, height):
+    """
+    Send a video whose bytes were already uploaded with pre_upload, the way
+    Client.send_video does for a local file. Returns the sent Message.
+    """
+    media = raw.types.InputMediaUploadedDocument(
+        mime_type="video/mp4",
+        file=uploaded,
+        thumb=await client.save_file(thumb) if thumb else None,
+        attributes=[
+            raw.types.DocumentAttributeVideo(supports_streaming=True, duration=duration, w=width, h=height),
+            raw.types.DocumentAttributeFilename(file_name=os.path.basename(path)),
+        ]
+    )
+    while True:
+        try:
+            r = await client.invoke(
+                raw.functions.messages.SendMedia(
+                    peer=await client.resolve_peer(chat_id),
+                    media=media,
+                    random_id=client.rnd_id(),
+                    **await utils.parse_text_entities(client, caption, None, None)
+                )
+            )
+        except FilePartMissing as e:
+            await client.save_file(path, file_id=uploaded.id, file_part=e.value)
+            continue
+        for update in r.updates:
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                return await types.Message._parse(
+                    client, update.message,
+                    {user.id: user for user in r.users},
+                    {chat.id: chat for chat in r.chats}
+                )
+        return None